@@ -0,0 +1,234 @@
+"""Exact and approximate (IVF) nearest-neighbour search over face embeddings.
+
+The IVF index partitions the L2-normalized 512-d embeddings produced by InceptionResnetV1 with
+spherical k-means. A query is only compared against the rows of the `nprobe` partitions whose
+centroids are closest to it, so search cost grows with nprobe instead of with the gallery size.
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+
+INDEX_VERSION = 1
+NPROBE_STEPS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def exact_search(queries, vectors, k, sq_norms=None):
+    """Returns (distances, ids) of the k rows of vectors closest in L2 to each query."""
+    queries = queries.reshape(-1, vectors.shape[1]).float()
+    k = min(k, len(vectors))
+    if sq_norms is None:
+        sq_norms = vectors.pow(2).sum(dim=1)
+    # ||q - v||^2 = ||q||^2 + ||v||^2 - 2 q.v for all pairs in one product
+    sq_dists = torch.addmm(
+        queries.pow(2).sum(dim=1, keepdim=True) + sq_norms,
+        queries, vectors.t(), alpha=-2,
+    )
+    top_sq, top_ids = torch.topk(sq_dists, k, dim=1, largest=False)
+    return top_sq.clamp_min_(0).sqrt_(), top_ids
+
+
+def merge_results(results, k):
+    """Merges (distances, ids) result sets for the same queries into a single top-k."""
+    distances = torch.cat([dists for dists, _ in results], dim=1)
+    ids = torch.cat([ids for _, ids in results], dim=1)
+    distances, order = distances.topk(min(k, distances.shape[1]), dim=1, largest=False)
+    return distances, ids.gather(1, order)
+
+
+def recall_at_k(approx_ids, exact_ids):
+    """Fraction of the exact top-k ids that also appear in the approximate top-k."""
+    hits = (approx_ids.unsqueeze(2) == exact_ids.unsqueeze(1)).any(dim=1)
+    return hits.float().mean().item()
+
+
+def _assign(x, centroids, chunk_size=65536):
+    """Returns the index of the closest centroid (by inner product) for each row of x."""
+    return torch.cat([
+        (x[i:i + chunk_size] @ centroids.t()).argmax(dim=1)
+        for i in range(0, len(x), chunk_size)
+    ])
+
+
+def kmeans(x, nlist, niter, generator):
+    """Spherical k-means: returns nlist L2-normalized centroids of the (normalized) rows of x."""
+    centroids = x[torch.randperm(len(x), generator=generator)[:nlist]].clone()
+    for _ in range(niter):
+        assign = _assign(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=nlist)
+        centroids = sums / counts.clamp_min(1).unsqueeze(1).to(x.dtype)
+        empty = (counts == 0).nonzero().flatten()
+        if len(empty) > 0:
+            # Reseed empty partitions with random points so every list stays usable
+            centroids[empty] = x[torch.randint(len(x), (len(empty),), generator=generator)]
+        centroids = F.normalize(centroids, dim=1)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index: coarse k-means partitions plus probing of the closest partitions.
+
+    Vectors are stored contiguously grouped by partition; `offsets[l]:offsets[l + 1]` is the slice
+    of partition l and `ids` maps each stored row back to its row in the original gallery.
+    """
+
+    def __init__(self, centroids, vectors, ids, offsets, recall_curve=None):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.sq_norms = vectors.pow(2).sum(dim=1)
+        self.recall_curve = recall_curve or []
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @property
+    def ntotal(self):
+        return len(self.vectors)
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, niter=20, max_train_points=256, seed=0):
+        """Trains partitions on (a sample of) embeddings and indexes all of them.
+
+        Arguments:
+            embeddings {torch.Tensor} -- N x 512 matrix of L2-normalized embeddings.
+
+        Keyword Arguments:
+            nlist {int} -- Number of partitions. (default: {4 * sqrt(N)})
+            niter {int} -- k-means iterations. (default: {20})
+            max_train_points {int} -- Training sample size per partition. (default: {256})
+            seed {int} -- Seed for sampling and centroid initialisation. (default: {0})
+        """
+        embeddings = embeddings.float().contiguous()
+        n = len(embeddings)
+        if nlist is None:
+            nlist = int(4 * math.sqrt(n))
+        nlist = max(1, min(nlist, n))
+
+        generator = torch.Generator().manual_seed(seed)
+        train = embeddings
+        if n > nlist * max_train_points:
+            train = embeddings[torch.randperm(n, generator=generator)[:nlist * max_train_points]]
+        centroids = kmeans(F.normalize(train, dim=1), nlist, niter, generator)
+
+        assign = _assign(embeddings, centroids)
+        order = torch.argsort(assign, stable=True)
+        counts = torch.bincount(assign, minlength=nlist)
+        offsets = torch.zeros(nlist + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(counts, dim=0)
+        return cls(centroids, embeddings[order].contiguous(), order, offsets)
+
+    def search(self, queries, k=1, nprobe=8):
+        """Returns (distances, ids) of the approximate k nearest gallery rows for each query.
+
+        Rows are padded with inf distances and -1 ids when the probed partitions hold fewer than
+        k vectors.
+        """
+        queries = queries.reshape(-1, self.vectors.shape[1]).float()
+        nprobe = max(1, min(nprobe, self.nlist))
+        probes = (queries @ self.centroids.t()).topk(nprobe, dim=1).indices.tolist()
+        offsets = self.offsets.tolist()
+
+        distances = torch.full((len(queries), k), math.inf)
+        ids = torch.full((len(queries), k), -1, dtype=torch.long)
+        for qi, lists in enumerate(probes):
+            spans = [(offsets[l], offsets[l + 1]) for l in lists if offsets[l + 1] > offsets[l]]
+            if not spans:
+                continue
+            rows = torch.cat([torch.arange(start, end) for start, end in spans])
+            dists, top = exact_search(queries[qi], self.vectors[rows], k, self.sq_norms[rows])
+            distances[qi, :dists.shape[1]] = dists[0]
+            ids[qi, :dists.shape[1]] = self.ids[rows[top[0]]]
+        return distances, ids
+
+    def calibrate(self, queries, k=1):
+        """Measures recall@k against exact search for increasing nprobe on sample queries."""
+        exact_ids = exact_search(queries, self.vectors, k, self.sq_norms)[1]
+        exact_ids = self.ids[exact_ids]
+        self.recall_curve = []
+        for nprobe in NPROBE_STEPS:
+            nprobe = min(nprobe, self.nlist)
+            recall = recall_at_k(self.search(queries, k, nprobe)[1], exact_ids)
+            self.recall_curve.append((nprobe, recall))
+            if nprobe == self.nlist or recall >= 1.0:
+                break
+        return self.recall_curve
+
+    def nprobe_for_recall(self, recall_target):
+        """Returns the smallest calibrated nprobe that reaches recall_target."""
+        for nprobe, recall in self.recall_curve:
+            if recall >= recall_target:
+                return nprobe
+        return self.nlist
+
+    def save(self, path):
+        torch.save({
+            'version': INDEX_VERSION,
+            'centroids': self.centroids,
+            'vectors': self.vectors,
+            'ids': self.ids,
+            'offsets': self.offsets,
+            'recall_curve': self.recall_curve,
+        }, path)
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_state(torch.load(path))
+
+    @classmethod
+    def from_state(cls, state):
+        if state.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {state.get('version')}")
+        return cls(
+            state['centroids'], state['vectors'], state['ids'], state['offsets'],
+            state['recall_curve'],
+        )
+
+
+def load_index(path, vectors=None):
+    """Loads an IVF or prototype index file. Prototype indexes re-check close calls against
+    vectors, the full-precision rows of the gallery they were built from.
+    """
+    state = torch.load(path)
+    if state.get('kind') == 'prototypes':
+        from prototypes import PrototypeIndex
+        return PrototypeIndex.from_state(state, vectors)
+    return IVFIndex.from_state(state)
+
+
+def perturb(embeddings, noise=0.7, seed=0):
+    """Returns L2-normalized copies of embeddings moved by roughly `noise` in L2 distance.
+
+    Used as stand-in queries for calibration: a new photo of an enrolled person lands near, not
+    on, the enrolled embedding.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    jitter = torch.randn(embeddings.shape, generator=generator) * (noise / math.sqrt(embeddings.shape[1]))
+    return F.normalize(embeddings + jitter, dim=1)
+
+
+if __name__ == '__main__':
+    import argparse
+    from gallery import Gallery
+
+    parser = argparse.ArgumentParser(description="Build an IVF index over a data.pt gallery.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('gallery', help="data.pt or gallery directory to index")
+    build_parser.add_argument('output', help="Path of the index file to write")
+    build_parser.add_argument('--nlist', type=int, default=None)
+    build_parser.add_argument('--niter', type=int, default=20)
+    build_parser.add_argument('--k', type=int, default=1, help="k used for recall calibration")
+    build_parser.add_argument('--calibration-queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    embeddings = Gallery.open(args.gallery).full.float()
+    index = IVFIndex.build(embeddings, nlist=args.nlist, niter=args.niter)
+    sample = torch.randperm(len(embeddings))[:args.calibration_queries]
+    for nprobe, recall in index.calibrate(perturb(embeddings[sample]), k=args.k):
+        print(f"[INFO] nprobe={nprobe:<5d} recall@{args.k}={recall:.4f}")
+    index.save(args.output)
+    print(f"[SUCCESS] Indexed {index.ntotal} embeddings in {index.nlist} partitions -> {args.output}")
@@ -1,7 +1,21 @@
-from face_recognition import face_match  # Your face recognition function
+import time
+STARTED_AT = time.time()  # Taken before the model imports below so time-to-ready includes them
+
+from face_recognition import face_match, face_match_many, get_recognizer, mtcnn, mtcnn_all, resnet
 import boto3
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
 import os
-import time
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from PIL import Image
+from calibration import SAMPLE_GLOB
 
 # ========== Configuration ==========
 ASU_ID = "1232089042"
@@ -9,6 +23,36 @@ S3_INPUT_BUCKET = f"{ASU_ID}-in-bucket"   # Where images are uploaded
 S3_OUTPUT_BUCKET = f"{ASU_ID}-out-bucket" # Where results are stored
 REQUEST_QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/390844739554/1232089042-req-queue'
 RESPONSE_QUEUE_URL  = 'https://sqs.us-east-1.amazonaws.com/390844739554/1232089042-resp-queue'
+DEAD_LETTER_QUEUE_URL = os.environ.get("WORKER_DLQ_URL")  # Quarantine queue; None keeps a local store
+QUARANTINE_PATH = os.environ.get(  # Local quarantine store, next to this file unless overridden
+    "WORKER_QUARANTINE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "quarantine.ndjson")
+)
+MAX_RECEIVES = int(os.environ.get("WORKER_MAX_RECEIVES", "5"))  # Attempts before a message is quarantined
+MESSAGE_ATTRIBUTES = ['Deadline', 'RequestId', 'ReplyTo', 'S3Key']  # Set by server.send_to_request_queue
+VISIBILITY_TIMEOUT = 15
+BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "10"))  # Tasks per micro-batch (at most 10)
+RECEIVE_WAIT_SECONDS = int(os.environ.get("WORKER_RECEIVE_WAIT", "20"))  # SQS long-poll wait
+BATCH_WINDOW = float(os.environ.get("WORKER_BATCH_WINDOW", "0.2"))  # Seconds spent filling a batch
+WORKER_MODE = os.environ.get("WORKER_MODE", "pipeline")  # pipeline, batch or serial
+DOWNLOAD_WORKERS = int(os.environ.get("WORKER_DOWNLOAD_THREADS", "8"))
+PUBLISH_WORKERS = int(os.environ.get("WORKER_PUBLISH_THREADS", "4"))  # Concurrent result uploads
+MAX_IN_FLIGHT = int(os.environ.get("WORKER_MAX_IN_FLIGHT", "40"))  # Hard cap on messages held at once
+VISIBILITY_BUDGET = 0.5  # Share of the visibility timeout the in-flight backlog may take to drain
+HEARTBEAT_INTERVAL = VISIBILITY_TIMEOUT / 3  # Seconds between visibility extensions
+STALL_TIMEOUT = float(os.environ.get("WORKER_STALL_TIMEOUT", "60"))  # Seconds in one stage before a message is released
+PUBLISH_BATCH_SIZE = 10  # SQS batch API limit
+PUBLISH_FLUSH_INTERVAL = float(os.environ.get("WORKER_PUBLISH_FLUSH", "0.1"))  # Max seconds a result waits
+RESULT_SHARDS = os.environ.get("WORKER_RESULT_SHARDS", "0") == "1"  # NDJSON shards instead of one object per image
+RESULT_SHARD_INTERVAL = float(os.environ.get("WORKER_RESULT_SHARD_INTERVAL", "5"))
+RESULT_SHARD_PREFIX = "results/"
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))  # Inference processes (0 = one per core)
+TORCH_THREADS = int(os.environ.get("WORKER_TORCH_THREADS", "0"))  # Per process (0 = cores / processes)
+RESTART_DELAY = 5  # Seconds before a crashed worker process is restarted
+CALIBRATE = os.environ.get("WORKER_CALIBRATE", "0") == "1"  # Use the calibrated profile, calibrating only if none exists
+LATENCY_TARGET = float(os.environ.get("WORKER_LATENCY_TARGET", "2.0"))  # p95 seconds per batch when calibrating
+PROFILE_S3_PREFIX = "worker-profiles/"  # Calibration profiles shared in S3_OUTPUT_BUCKET, one per hardware
+READY_FILE = os.environ.get("WORKER_READY_FILE", "/tmp/face-worker.ready")  # Written once warmed up
+WARMUP_SIZES = ((250, 250), (640, 480), (1280, 720))  # Request image shapes run through the models first
 
 # ========== AWS Clients ==========
 aws_session = boto3.Session(region_name="us-east-1")
@@ -16,15 +60,16 @@ s3 = aws_session.client('s3')  # For file storage/download
 sqs = aws_session.client('sqs')  # For task queues
 
 # ========== Helper Functions ==========
-def download_image_from_s3(filename: str) -> str:
-    """Downloads an image from S3 to local storage."""
+def fetch_image_from_s3(key: str) -> io.BytesIO:
+    """Downloads an image from S3 into an in-memory buffer."""
     try:
-        print(f"[DEBUG] Downloading {filename} from S3...")
-        local_path = f"{filename}"  # Save in /tmp (recommended for AWS Lambda)
-        s3.download_file(S3_INPUT_BUCKET, filename, local_path)
-        return local_path
+        print(f"[DEBUG] Fetching {key} from S3...")
+        buffer = io.BytesIO()
+        s3.download_fileobj(S3_INPUT_BUCKET, key, buffer)
+        buffer.seek(0)
+        return buffer
     except Exception as e:
-        print(f"[ERROR] Failed to download {filename}: {e}")
+        print(f"[ERROR] Failed to fetch {key}: {e}")
         raise
 
 def upload_result_to_s3(filename: str, result: str):
@@ -36,85 +81,807 @@ def upload_result_to_s3(filename: str, result: str):
         print(f"[ERROR] Failed to upload result for {filename}: {e}")
         raise
 
-def send_result_to_queue(result: str):
-    """Sends the recognition result to the response queue."""
+def reply_message(task: dict, result: str) -> dict:
+    """The response-queue message for a task's result, tagged with the task's request ID, the
+    version of the gallery it was matched against and the seconds since the task was received.
+    """
+    message = {'MessageBody': result, 'MessageAttributes': {
+        'ServiceTime': {'DataType': 'Number', 'StringValue': f"{time.time() - task['received_at']:.3f}"},
+    }}
+    if task.get('gallery_version'):
+        message['MessageAttributes']['GalleryVersion'] = {'DataType': 'String', 'StringValue': task['gallery_version']}
+    if task.get('request_id'):
+        message['MessageAttributes']['RequestId'] = {'DataType': 'String', 'StringValue': task['request_id']}
+    return message
+
+def gallery_version() -> str:
+    """The version a result is tagged with, "generation.rows.fingerprint" of the gallery.
+
+    Taken before inference: should the gallery be reloaded mid-match, the result is tagged with
+    the older version, so the web tier never caches a stale match under the newer one.
+    """
+    generation, rows, fingerprint = get_recognizer().version
+    return f"{generation}.{rows}.{fingerprint}"
+
+def send_result_to_queue(result: str, task: dict):
+    """Sends the recognition result to the response queue the request asked for."""
     try:
         print(f"[DEBUG] Sending result to response queue: {result}")
-        sqs.send_message(QueueUrl=RESPONSE_QUEUE_URL, MessageBody=result)
+        sqs.send_message(QueueUrl=task.get('reply_to') or RESPONSE_QUEUE_URL, **reply_message(task, result))
     except Exception as e:
         print(f"[ERROR] Failed to send result to queue: {e}")
         raise
 
-def recognize_face(filename: str, image_path: str) -> str:
-    """Runs face recognition and returns formatted result."""
+def recognize_face(filename: str, image) -> str:
+    """Runs face recognition on an image path or buffer and returns formatted result."""
     try:
         print(f"[DEBUG] Processing {filename}...")
-        classification = face_match(image_path)[0]  # Your face recognition logic
+        classification = face_match(image)[0]  # Your face recognition logic
         return f"{filename}:{classification}"
     except Exception as e:
         print(f"[ERROR] Face recognition failed for {filename}: {e}")
         return f"{filename}:error"
 
+def recognize_faces(filenames: list, images: list) -> list:
+    """Runs batched face recognition and returns one formatted result per file."""
+    try:
+        print(f"[DEBUG] Processing batch of {len(filenames)}...")
+        matches = face_match_many(images)
+    except Exception as e:
+        print(f"[ERROR] Batch face recognition failed: {e}")
+        matches = [None] * len(filenames)
+    return [
+        f"{filename}:{match[0]}" if match else f"{filename}:error"
+        for filename, match in zip(filenames, matches)
+    ]
+
+def to_task(message: dict) -> dict:
+    attributes = {
+        name: value['StringValue'] for name, value in message.get('MessageAttributes', {}).items()
+    }
+    return {
+        'filename': message['Body'],
+        'key': attributes.get('S3Key', message['Body']),
+        'receipt_handle': message['ReceiptHandle'],
+        'receive_count': int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+        'deadline': float(attributes['Deadline']) if 'Deadline' in attributes else None,
+        'request_id': attributes.get('RequestId'),
+        'reply_to': attributes.get('ReplyTo'),
+        'received_at': time.time(),
+    }
+
 def fetch_next_task():
     """Fetches the next task from the request queue."""
     try:
         response = sqs.receive_message(
             QueueUrl=REQUEST_QUEUE_URL,
             MaxNumberOfMessages=1,
-            VisibilityTimeout=15,
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            AttributeNames=['ApproximateReceiveCount'],
+            MessageAttributeNames=MESSAGE_ATTRIBUTES,
         )
         messages = response.get('Messages', [])
         if not messages:
             print("[DEBUG] No tasks in queue. Waiting...")
             return None
         
-        message = messages[0]
-        return {
-            'filename': message['Body'],
-            'receipt_handle': message['ReceiptHandle']
-        }
+        return to_task(messages[0])
     except Exception as e:
         print(f"[ERROR] Failed to fetch task from queue: {e}")
         return None
 
+def fetch_tasks(max_messages: int = BATCH_SIZE, wait_seconds: int = RECEIVE_WAIT_SECONDS) -> list:
+    """Long-polls the request queue for up to max_messages (at most 10) tasks."""
+    try:
+        response = sqs.receive_message(
+            QueueUrl=REQUEST_QUEUE_URL,
+            MaxNumberOfMessages=max(1, min(max_messages, 10)),
+            WaitTimeSeconds=wait_seconds,
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            AttributeNames=['ApproximateReceiveCount'],
+            MessageAttributeNames=MESSAGE_ATTRIBUTES,
+        )
+        return [to_task(message) for message in response.get('Messages', [])]
+    except Exception as e:
+        print(f"[ERROR] Failed to fetch tasks from queue: {e}")
+        time.sleep(1)
+        return []
+
+def collect_batch() -> list:
+    """Waits for the first tasks, then spends up to BATCH_WINDOW seconds filling the batch."""
+    tasks = fetch_tasks(BATCH_SIZE, RECEIVE_WAIT_SECONDS)
+    deadline = time.time() + BATCH_WINDOW
+    while tasks and len(tasks) < BATCH_SIZE and time.time() < deadline:
+        more = fetch_tasks(BATCH_SIZE - len(tasks), wait_seconds=0)
+        if not more:
+            time.sleep(min(0.05, max(0, deadline - time.time())))
+        tasks.extend(more)
+    return tasks
+
+def delete_messages(tasks: list) -> list:
+    """Deletes the tasks' request messages in batches. Returns whether each one was deleted."""
+    deleted = []
+    for start in range(0, len(tasks), PUBLISH_BATCH_SIZE):
+        chunk = tasks[start:start + PUBLISH_BATCH_SIZE]
+        try:
+            response = sqs.delete_message_batch(
+                QueueUrl=REQUEST_QUEUE_URL,
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': task['receipt_handle']}
+                    for i, task in enumerate(chunk)
+                ],
+            )
+            failed = {int(failure['Id']): failure for failure in response.get('Failed', [])}
+        except Exception as e:
+            print(f"[ERROR] Failed to delete {len(chunk)} messages: {e}")
+            failed = dict.fromkeys(range(len(chunk)), {})
+        for i, task in enumerate(chunk):
+            if i in failed:
+                print(f"[ERROR] Failed to delete {task['filename']}: {failed[i].get('Message')}")
+            deleted.append(i not in failed)
+    return deleted
+
+# ========== Expired Requests ==========
+EXPIRED = {'download': 0, 'inference': 0}  # Requests dropped past their deadline, by the stage skipped
+_expired_lock = threading.Lock()
+
+def drop_expired(tasks: list, stage: str) -> list:
+    """Deletes tasks whose client deadline has passed before they reach stage; returns the rest."""
+    now = time.time()
+    live = [task for task in tasks if task.get('deadline') is None or task['deadline'] > now]
+    if len(live) == len(tasks):
+        return tasks
+    expired = [task for task in tasks if task not in live]
+    delete_messages(expired)
+    with _expired_lock:
+        EXPIRED[stage] += len(expired)
+        print(f"[INFO] Dropped {len(expired)} expired requests before {stage} (totals: {EXPIRED})")
+    return live
+
+# ========== Poison Messages ==========
+_quarantine_lock = threading.Lock()
+QUARANTINE_FAILURES = {'record': 0, 'release': 0}  # Quarantine steps that failed, by step
+
+def quarantine(task: dict, reason: str):
+    """Moves a message out of the request queue and sends the web tier an error result.
+
+    The message is recorded in the dead-letter queue when one is configured, otherwise in the
+    local QUARANTINE_PATH store (one JSON object per line). A failed record is logged and
+    counted, but the error result is still sent and the message still deleted.
+    """
+    record = {
+        'filename': task['filename'],
+        'request_id': task.get('request_id'),
+        'receive_count': task['receive_count'],
+        'reason': reason,
+        'quarantined_at': time.time(),
+    }
+    try:
+        if DEAD_LETTER_QUEUE_URL:
+            sqs.send_message(QueueUrl=DEAD_LETTER_QUEUE_URL, MessageBody=json.dumps(record))
+        else:
+            with _quarantine_lock, open(QUARANTINE_PATH, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        QUARANTINE_FAILURES['record'] += 1
+        print(f"[ERROR] Failed to record quarantined {task['filename']}: {e} (failures: {QUARANTINE_FAILURES})")
+    try:
+        send_result_to_queue(f"{task['filename']}:error", task)
+        sqs.delete_message(QueueUrl=REQUEST_QUEUE_URL, ReceiptHandle=task['receipt_handle'])
+        print(f"[ERROR] Quarantined {task['filename']} after {task['receive_count']} attempts: {reason}")
+    except Exception as e:
+        QUARANTINE_FAILURES['release'] += 1
+        print(f"[ERROR] Failed to quarantine {task['filename']}: {e} (failures: {QUARANTINE_FAILURES})")
+
+def admit(tasks: list) -> list:
+    """Quarantines tasks that were already received MAX_RECEIVES times and returns the rest."""
+    admitted = []
+    for task in tasks:
+        if task['receive_count'] > MAX_RECEIVES:
+            quarantine(task, f"received more than {MAX_RECEIVES} times")
+        else:
+            admitted.append(task)
+    return admitted
+
+def download_failed(task: dict, error: Exception):
+    """Quarantines a task whose last allowed attempt failed; earlier attempts are redelivered."""
+    if task['receive_count'] >= MAX_RECEIVES:
+        quarantine(task, f"download failed: {error}")
+
 # ========== Main Worker Loop ==========
 def process_tasks_forever():
     """Continuously processes tasks from the queue."""
+    in_flight = InFlight()
+    threading.Thread(target=heartbeat, args=(in_flight,), daemon=True).start()
     while True:
+        task = None
         try:
             # 1. Get next task
             task = fetch_next_task()
             if not task:
                 time.sleep(1)  # Wait before checking again
                 continue
+            if not drop_expired(admit([task]), 'download'):
+                continue
+            in_flight.add([task])
 
             filename = task['filename']
             receipt_handle = task['receipt_handle']
 
-            # 2. Download image
-            image_path = download_image_from_s3(filename)
+            # 2. Download image into memory
+            try:
+                image = fetch_image_from_s3(task['key'])
+            except Exception as e:
+                download_failed(task, e)
+                continue
 
             # 3. Process image
-            result = recognize_face(filename, image_path)
+            if not drop_expired([task], 'inference'):
+                continue
+            in_flight.advance(task, 'inference')
+            task['gallery_version'] = gallery_version()
+            result = recognize_face(filename, image)
+            in_flight.advance(task, 'publish')
+            if not in_flight.drop_lapsed([task]):
+                continue
 
             # 4. Upload result
             upload_result_to_s3(filename, result)
 
             # 5. Send result to response queue
-            send_result_to_queue(result)
+            send_result_to_queue(result, task)
 
             # 6. Cleanup
-            os.remove(image_path)
             sqs.delete_message(
                 QueueUrl=REQUEST_QUEUE_URL,
                 ReceiptHandle=receipt_handle
             )
+            task['completed'] = True
             print(f"[SUCCESS] Processed {filename}")
 
         except Exception as e:
             print(f"[CRITICAL] Task failed: {e}. Retrying...")
             time.sleep(5)
+        finally:
+            if task:
+                in_flight.done(task)
+
+def process_batches_forever():
+    """Continuously processes micro-batches of tasks from the queue."""
+    in_flight = InFlight()
+    threading.Thread(target=heartbeat, args=(in_flight,), daemon=True).start()
+    while True:
+        tasks = []
+        try:
+            # 1. Long-poll for a batch of tasks
+            tasks = drop_expired(admit(collect_batch()), 'download')
+            if not tasks:
+                print("[DEBUG] No tasks in queue. Waiting...")
+                continue
+            in_flight.add(tasks)
+
+            # 2. Download images; failed downloads are redelivered or quarantined
+            ready, images = [], []
+            for task in tasks:
+                try:
+                    images.append(fetch_image_from_s3(task['key']))
+                    ready.append(task)
+                except Exception as e:
+                    download_failed(task, e)
+
+            # 3. Detect and embed the whole batch together
+            live = drop_expired(ready, 'inference')
+            images = [image for task, image in zip(ready, images) if task in live]
+            ready = live
+            version = gallery_version()
+            for task in ready:
+                in_flight.advance(task, 'inference')
+                task['gallery_version'] = version
+            results = recognize_faces([task['filename'] for task in ready], images)
+
+            # 4. Publish results and clean up
+            for task, result in zip(ready, results):
+                in_flight.advance(task, 'publish')
+                if not in_flight.drop_lapsed([task]):
+                    continue
+                try:
+                    upload_result_to_s3(task['filename'], result)
+                    send_result_to_queue(result, task)
+                    sqs.delete_message(
+                        QueueUrl=REQUEST_QUEUE_URL,
+                        ReceiptHandle=task['receipt_handle']
+                    )
+                    task['completed'] = True
+                    print(f"[SUCCESS] Processed {task['filename']}")
+                except Exception as e:
+                    print(f"[ERROR] Failed to publish {task['filename']}: {e}")
+
+        except Exception as e:
+            print(f"[CRITICAL] Batch failed: {e}. Retrying...")
+            time.sleep(5)
+        finally:
+            # Unfinished messages stop being extended and are redelivered
+            for task in tasks:
+                in_flight.done(task)
+
+# ========== Result Publisher ==========
+class ResultPublisher:
+    """Publishes results with batched SQS calls.
+
+    Results are sent with send_message_batch and their requests deleted with
+    delete_message_batch, in groups of up to PUBLISH_BATCH_SIZE. A group is flushed when it is
+    full or PUBLISH_FLUSH_INTERVAL has passed. With RESULT_SHARDS, output-bucket results are
+    written as one NDJSON object per RESULT_SHARD_INTERVAL instead of one object per image. The
+    requests are only deleted once their shard is stored. on_done is called with every task
+    when the publisher is finished with it, whether or not it was deleted. held filters a list
+    of tasks down to the ones whose messages are still held, just before results are sent and
+    before requests are deleted; it finishes the others itself.
+    """
+
+    def __init__(self, on_done=None, shards=RESULT_SHARDS, held=None):
+        self.on_done = on_done or (lambda task: None)
+        self.held = held or (lambda tasks: tasks)
+        self.shards = shards
+        self.pending = []  # (task, result) not yet sent
+        self.shard_lines, self.shard_tasks = [], []
+        self.shard_started = time.time()
+        self.upload_pool = ThreadPoolExecutor(PUBLISH_WORKERS)
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def publish(self, task: dict, result: str):
+        with self.cond:
+            self.pending.append((task, result))
+            if len(self.pending) >= PUBLISH_BATCH_SIZE:
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if len(self.pending) < PUBLISH_BATCH_SIZE:
+                    self.cond.wait(PUBLISH_FLUSH_INTERVAL)
+                batch = self.pending[:PUBLISH_BATCH_SIZE]
+                self.pending = self.pending[PUBLISH_BATCH_SIZE:]
+            try:
+                if batch:
+                    self._flush(batch)
+                if self.shard_tasks and time.time() - self.shard_started >= RESULT_SHARD_INTERVAL:
+                    self._flush_shard()
+            except Exception as e:
+                print(f"[CRITICAL] Publisher failed: {e}. Retrying...")
+                for task, _ in batch:
+                    self.on_done(task)
+                time.sleep(1)
+
+    def _flush(self, batch: list):
+        held = self.held([task for task, _ in batch])
+        batch = [(task, result) for task, result in batch if task in held]
+        if not self.shards:
+            uploads = [
+                self.upload_pool.submit(upload_result_to_s3, task['filename'], result)
+                for task, result in batch
+            ]
+            stored = []
+            for (task, result), upload in zip(batch, uploads):
+                try:
+                    upload.result()
+                    stored.append((task, result))
+                except Exception:
+                    self.on_done(task)
+            batch = stored
+
+        sent = self._send(batch)
+        if self.shards:
+            if not self.shard_tasks:
+                self.shard_started = time.time()
+            self.shard_lines.extend(
+                json.dumps({'filename': task['filename'], 'request_id': task.get('request_id'), 'result': result})
+                for task, result in sent
+            )
+            self.shard_tasks.extend(task for task, _ in sent)
+        else:
+            self._delete([task for task, _ in sent])
+
+    def _send(self, batch: list) -> list:
+        """Sends results to their response queues and returns the (task, result) pairs that were sent."""
+        by_queue = {}
+        for i, (task, _) in enumerate(batch):
+            by_queue.setdefault(task.get('reply_to') or RESPONSE_QUEUE_URL, []).append(i)
+
+        sent = set()
+        for queue_url, indexes in by_queue.items():
+            print(f"[DEBUG] Sending {len(indexes)} results to {queue_url}")
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': str(i), **reply_message(*batch[i])} for i in indexes],
+                )
+                sent.update(int(entry['Id']) for entry in response.get('Successful', []))
+            except Exception as e:
+                print(f"[ERROR] Failed to send results to {queue_url}: {e}")
+        for i, (task, _) in enumerate(batch):
+            if i not in sent:
+                print(f"[ERROR] Failed to send result for {task['filename']}")
+                self.on_done(task)
+        return [item for i, item in enumerate(batch) if i in sent]
+
+    def _delete(self, tasks: list):
+        tasks = self.held(tasks)
+        for task, deleted in zip(tasks, delete_messages(tasks)):
+            if deleted:
+                task['completed'] = True
+                print(f"[SUCCESS] Processed {task['filename']}")
+            self.on_done(task)
+
+    def _flush_shard(self):
+        key = f"{RESULT_SHARD_PREFIX}{socket.gethostname()}-{os.getpid()}/{int(time.time() * 1000)}.ndjson"
+        tasks, lines = self.shard_tasks, self.shard_lines
+        self.shard_tasks, self.shard_lines = [], []
+        try:
+            print(f"[DEBUG] Uploading result shard {key} ({len(lines)} results)")
+            s3.put_object(Bucket=S3_OUTPUT_BUCKET, Key=key, Body="\n".join(lines) + "\n")
+        except Exception as e:
+            # The requests stay on the queue and are redelivered
+            print(f"[ERROR] Failed to upload result shard {key}: {e}")
+            for task in tasks:
+                self.on_done(task)
+            return
+        self._delete(tasks)
+
+# ========== Pipelined Worker ==========
+class InFlight:
+    """Messages received but not yet finished, capped to what can be finished in time.
+
+    The cap starts at MAX_IN_FLIGHT and then follows the measured inference time per task, so
+    the whole backlog drains within VISIBILITY_BUDGET of the visibility timeout. Each task
+    records its current stage and when it entered it, which the heartbeat uses to tell slow
+    progress from a stall.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.tasks = {}  # receipt handle -> task
+        self.service_time = None
+        self.cond = threading.Condition()
+        self.heartbeats = 0  # Visibility extensions sent
+        self.released = 0  # Stalled messages handed back to the queue
+        self.duplicates_avoided = 0  # Messages finished after their original visibility ran out
+        self.dropped = 0  # Results dropped because their message's visibility had lapsed
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self.tasks),
+            'heartbeats': self.heartbeats,
+            'released': self.released,
+            'duplicates_avoided': self.duplicates_avoided,
+            'dropped': self.dropped,
+        }
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def wait_for_room(self) -> int:
+        """Blocks until more messages may be received and returns how many."""
+        with self.cond:
+            while len(self.tasks) >= self.limit:
+                self.cond.wait()
+            return self.limit - len(self.tasks)
+
+    def add(self, tasks: list):
+        now = time.time()
+        with self.cond:
+            for task in tasks:
+                task['received_at'] = now
+                task['visible_at'] = now + VISIBILITY_TIMEOUT
+                self.tasks[task['receipt_handle']] = task
+                self.advance(task, 'download')
+
+    def advance(self, task: dict, stage: str):
+        task['stage'] = stage
+        task['stage_started'] = time.time()
+
+    def done(self, task: dict):
+        with self.cond:
+            if self.tasks.pop(task['receipt_handle'], None) is None:
+                return
+            if task.get('completed') and time.time() > task['received_at'] + VISIBILITY_TIMEOUT:
+                self.duplicates_avoided += 1
+            self.cond.notify_all()
+
+    def due(self, horizon: float):
+        """Splits tasks whose visibility ends within horizon seconds into (progressing, stalled)."""
+        now = time.time()
+        with self.cond:
+            expiring = [task for task in self.tasks.values() if task['visible_at'] - now < horizon]
+        progressing = [task for task in expiring if now - task['stage_started'] < STALL_TIMEOUT]
+        stalled = [task for task in expiring if now - task['stage_started'] >= STALL_TIMEOUT]
+        return progressing, stalled
+
+    def extended(self, tasks: list):
+        visible_at = time.time() + VISIBILITY_TIMEOUT
+        with self.cond:
+            for task in tasks:
+                task['visible_at'] = visible_at
+            self.heartbeats += len(tasks)
+
+    def release(self, tasks: list):
+        with self.cond:
+            for task in tasks:
+                task['released'] = True
+                if self.tasks.pop(task['receipt_handle'], None) is not None:
+                    self.released += 1
+            self.cond.notify_all()
+
+    def drop_lapsed(self, tasks: list) -> list:
+        """Returns the tasks whose messages are still held. The others were released, or their
+        visibility ran out without being extended, so the message may already be with another
+        worker; they are finished without publishing, as their receipt handles are stale.
+        """
+        now = time.time()
+        held = []
+        for task in tasks:
+            if task.get('released') or now >= task['visible_at']:
+                print(f"[WARNING] Visibility of {task['filename']} lapsed; dropping its result")
+                with self.cond:
+                    self.dropped += 1
+                self.done(task)
+            else:
+                held.append(task)
+        return held
+
+    def record(self, n_tasks: int, seconds: float):
+        """Updates the per-task inference time and the in-flight cap derived from it."""
+        with self.cond:
+            per_task = seconds / max(n_tasks, 1)
+            if self.service_time is None:
+                self.service_time = per_task
+            else:
+                self.service_time = 0.8 * self.service_time + 0.2 * per_task
+            affordable = int(VISIBILITY_TIMEOUT * VISIBILITY_BUDGET / max(self.service_time, 1e-3))
+            self.limit = max(BATCH_SIZE, min(self.max_in_flight, affordable))
+            self.cond.notify_all()
+
+def prefetch_tasks(in_flight: InFlight, downloads: queue.Queue):
+    """Receives messages whenever the in-flight cap leaves room for them."""
+    while True:
+        room = in_flight.wait_for_room()
+        tasks = drop_expired(admit(fetch_tasks(min(room, BATCH_SIZE), RECEIVE_WAIT_SECONDS)), 'download')
+        in_flight.add(tasks)
+        for task in tasks:
+            downloads.put(task)
+
+def download_tasks(in_flight: InFlight, downloads: queue.Queue, ready: queue.Queue):
+    """Downloads images for received tasks; failed downloads are redelivered or quarantined."""
+    while True:
+        task = downloads.get()
+        try:
+            image = fetch_image_from_s3(task['key'])
+            in_flight.advance(task, 'inference')
+            ready.put((task, image))
+        except Exception as e:
+            download_failed(task, e)
+            in_flight.done(task)
+
+def run_inference(in_flight: InFlight, ready: queue.Queue, publisher: ResultPublisher):
+    """Recognizes downloaded images in batches of up to BATCH_SIZE."""
+    while True:
+        try:
+            batch = [ready.get()]
+            deadline = time.time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(ready.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            live = drop_expired([task for task, _ in batch], 'inference')
+            for task, _ in batch:
+                if task not in live:
+                    in_flight.done(task)
+            batch = [(task, image) for task, image in batch if task in live]
+            if not batch:
+                continue
+
+            version = gallery_version()
+            for task, _ in batch:
+                task['gallery_version'] = version
+            start = time.time()
+            outputs = recognize_faces([task['filename'] for task, _ in batch], [image for _, image in batch])
+            in_flight.record(len(batch), time.time() - start)
+            for (task, _), result in zip(batch, outputs):
+                in_flight.advance(task, 'publish')
+                publisher.publish(task, result)
+        except Exception as e:
+            print(f"[CRITICAL] Inference stage failed: {e}. Retrying...")
+            time.sleep(5)
+
+def change_visibility(tasks: list, timeout: int) -> list:
+    """Sets the visibility timeout of the tasks' messages in batches. Returns the tasks that succeeded."""
+    changed = []
+    for start in range(0, len(tasks), PUBLISH_BATCH_SIZE):
+        chunk = tasks[start:start + PUBLISH_BATCH_SIZE]
+        try:
+            response = sqs.change_message_visibility_batch(
+                QueueUrl=REQUEST_QUEUE_URL,
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': task['receipt_handle'], 'VisibilityTimeout': timeout}
+                    for i, task in enumerate(chunk)
+                ],
+            )
+            changed.extend(chunk[int(entry['Id'])] for entry in response.get('Successful', []))
+        except Exception as e:
+            print(f"[ERROR] Failed to change visibility of {len(chunk)} messages: {e}")
+    return changed
+
+def heartbeat(in_flight: InFlight):
+    """Extends the visibility of messages that are still progressing and releases stalled ones.
+
+    A message is stalled once it has spent STALL_TIMEOUT seconds in one stage; its visibility is
+    set to 0 so another worker can pick it up straight away.
+    """
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            progressing, stalled = in_flight.due(2 * HEARTBEAT_INTERVAL)
+            if progressing:
+                in_flight.extended(change_visibility(progressing, VISIBILITY_TIMEOUT))
+            if stalled:
+                for task in stalled:
+                    print(f"[ERROR] {task['filename']} stalled in {task['stage']}; releasing it")
+                change_visibility(stalled, 0)
+                in_flight.release(stalled)
+            if progressing or stalled:
+                print(f"[DEBUG] Heartbeat: {in_flight.stats()}")
+        except Exception as e:
+            print(f"[ERROR] Heartbeat failed: {e}")
+
+def process_pipeline_forever():
+    """Runs prefetch, download, inference and publish as overlapping stages.
+
+    Stages are connected by queues; the in-flight cap bounds everything held across them.
+    Inference runs on the calling thread.
+    """
+    in_flight = InFlight()
+    downloads, ready = queue.Queue(), queue.Queue()
+    publisher = ResultPublisher(on_done=in_flight.done, held=in_flight.drop_lapsed)
+    threading.Thread(target=prefetch_tasks, args=(in_flight, downloads), daemon=True).start()
+    threading.Thread(target=heartbeat, args=(in_flight,), daemon=True).start()
+    for _ in range(DOWNLOAD_WORKERS):
+        threading.Thread(target=download_tasks, args=(in_flight, downloads, ready), daemon=True).start()
+    run_inference(in_flight, ready, publisher)
+
+# ========== Warm-up and Readiness ==========
+READY = threading.Event()
+
+def warm_up():
+    """Runs MTCNN (single- and multi-face), InceptionResnetV1 and a gallery search over
+    representative shapes and batch sizes.
+
+    This pays allocator growth, first-call kernel selection and MTCNN pyramid setup before the
+    first real request instead of during it. The models and gallery are called directly, so the
+    hot tier and its counters only ever see real traffic.
+    """
+    start = time.time()
+    recognizer = get_recognizer()
+    samples = sorted(glob.glob(SAMPLE_GLOB))
+    if samples:
+        sample = Image.open(samples[0]).convert('RGB')
+        for size in WARMUP_SIZES:
+            recognizer.embed_many([sample.resize(size)])
+            recognizer.embed_all(sample.resize(size))
+        embeddings = [emb for emb in recognizer.embed_many([sample] * BATCH_SIZE) if emb is not None]
+        if embeddings:
+            with torch.inference_mode():
+                recognizer.gallery.search(torch.stack(embeddings), 1, recognizer.index, recognizer.nprobe)
+    else:
+        print(f"[WARNING] No warm-up images match {SAMPLE_GLOB}; warming the embedder only")
+        with torch.inference_mode():
+            for n in sorted({1, BATCH_SIZE}):
+                resnet(torch.zeros(n, 3, mtcnn.image_size, mtcnn.image_size))
+    print(f"[INFO] Warm-up took {time.time() - start:.1f}s")
+
+def mark_ready():
+    time_to_ready = time.time() - STARTED_AT
+    with open(READY_FILE + '.tmp', 'w') as f:
+        json.dump({'pid': os.getpid(), 'time_to_ready': time_to_ready}, f)
+    os.replace(READY_FILE + '.tmp', READY_FILE)
+    READY.set()
+    print(f"[SUCCESS] Worker {os.getpid()} ready {time_to_ready:.1f}s after start")
+
+def clear_ready():
+    READY.clear()
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+
+def run_worker():
+    """Warms up, then runs the worker loop selected by WORKER_MODE in this process."""
+    warm_up()
+    mark_ready()
+    if WORKER_MODE == 'pipeline':
+        process_pipeline_forever()
+    elif WORKER_MODE == 'batch':
+        process_batches_forever()
+    else:
+        process_tasks_forever()
+
+# ========== Supervisor ==========
+def preload_shared():
+    """Loads the gallery and moves model weights to shared memory before forking workers.
+
+    Forked workers reconnect to shard servers on their own (FaceRecognizer.after_fork).
+    """
+    for model in (mtcnn, mtcnn_all, resnet):
+        model.share_memory()
+    get_recognizer()
+
+def worker_process(threads: int):
+    torch.set_num_threads(threads)
+    print(f"[INFO] Worker process {os.getpid()} started with {threads} torch threads")
+    run_worker()
+
+def supervise(processes: int, threads: int):
+    """Forks worker processes that share the preloaded weights and restarts any that exit.
+
+    Each worker warms up on its own; READY_FILE appears once the first one is ready.
+    """
+    preload_shared()
+    context = multiprocessing.get_context('fork')
+
+    def start():
+        process = context.Process(target=worker_process, args=(threads,), daemon=True)
+        process.start()
+        return process
+
+    workers = [start() for _ in range(processes)]
+    while True:
+        time.sleep(1)
+        for i, process in enumerate(workers):
+            if not process.is_alive():
+                print(f"[ERROR] Worker process {process.pid} exited with code {process.exitcode}. "
+                      f"Restarting in {RESTART_DELAY}s...")
+                time.sleep(RESTART_DELAY)
+                workers[i] = start()
+
+# ========== Calibration Profile ==========
+def load_worker_profile():
+    """Returns the calibration profile for this hardware: the local copy, else the one another
+    instance shared in S3, else a fresh calibration, which is then shared.
+    """
+    from calibration import PROFILE_PATH, hardware_fingerprint, load_or_calibrate, load_profile
+
+    key = f"{PROFILE_S3_PREFIX}{hashlib.sha1(hardware_fingerprint().encode()).hexdigest()}.json"
+    if load_profile(latency_target=LATENCY_TARGET) is None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(PROFILE_PATH)), exist_ok=True)
+            s3.download_file(S3_OUTPUT_BUCKET, key, PROFILE_PATH + '.s3')
+            os.replace(PROFILE_PATH + '.s3', PROFILE_PATH)
+            print(f"[INFO] Downloaded shared worker profile s3://{S3_OUTPUT_BUCKET}/{key}")
+        except Exception as e:
+            print(f"[INFO] No shared worker profile at s3://{S3_OUTPUT_BUCKET}/{key}: {e}")
+
+    shared = load_profile(latency_target=LATENCY_TARGET) is not None
+    profile = load_or_calibrate(latency_target=LATENCY_TARGET)
+    if not shared:
+        try:
+            s3.upload_file(PROFILE_PATH, S3_OUTPUT_BUCKET, key)
+            print(f"[SUCCESS] Shared worker profile as s3://{S3_OUTPUT_BUCKET}/{key}")
+        except Exception as e:
+            print(f"[ERROR] Failed to share worker profile: {e}")
+    return profile
 
 if __name__ == '__main__':
     print("[INFO] Starting face recognition worker...")
-    process_tasks_forever()
\ No newline at end of file
+    clear_ready()
+    processes = WORKER_PROCESSES or os.cpu_count()
+    threads = TORCH_THREADS or max(1, os.cpu_count() // processes)
+    if CALIBRATE:
+        profile = load_worker_profile()
+        processes, threads, BATCH_SIZE = profile['processes'], profile['threads'], profile['batch_size']
+    print(f"[CONFIG] Mode: {WORKER_MODE} | Batch size: {BATCH_SIZE} | Batch window: {BATCH_WINDOW}s | "
+          f"Processes: {processes} | Torch threads: {threads}")
+    if processes > 1:
+        supervise(processes, threads)
+    else:
+        torch.set_num_threads(threads)
+        run_worker()
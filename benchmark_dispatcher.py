@@ -0,0 +1,92 @@
+"""Wake-up latency of the web tier's result dispatcher with many concurrent waiters.
+
+Starts N waiting requests on one event loop, then feeds their results through an in-memory
+response queue that hands out batches of 10 like SQS. Reports how long the dispatcher takes to
+wake every waiter, per-waiter latency percentiles and the state left behind.
+
+    python benchmark_dispatcher.py --waiters 20000
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from collections import deque
+
+import server
+
+
+class MemoryQueue:
+    """Stands in for the SQS response queue: receive_message returns up to 10 queued results."""
+
+    def __init__(self):
+        self.bodies = deque()
+        self.lock = threading.Lock()
+        self.receives = 0
+
+    def receive_message(self, **kwargs):
+        with self.lock:
+            self.receives += 1
+            n = min(kwargs.get('MaxNumberOfMessages', 1), len(self.bodies))
+            bodies = [self.bodies.popleft() for _ in range(n)]
+        if not bodies:
+            time.sleep(0.01)
+        return {'Messages': [
+            {
+                'Body': body,
+                'ReceiptHandle': request_id,
+                'MessageAttributes': {'RequestId': {'DataType': 'String', 'StringValue': request_id}},
+            }
+            for body, request_id in bodies
+        ]}
+
+    def delete_message_batch(self, **kwargs):
+        return {'Successful': [{'Id': entry['Id']} for entry in kwargs['Entries']]}
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))]
+
+
+async def run(waiters, timeout):
+    queue = MemoryQueue()
+    server.sqs = queue
+    dispatcher = server.ResultDispatcher()
+    poller = asyncio.create_task(dispatcher.run())
+    sent_at = {}
+
+    async def request(i):
+        await dispatcher.wait(f'req{i}', timeout)
+        return time.perf_counter() - sent_at[f'req{i}']
+
+    requests = [asyncio.create_task(request(i)) for i in range(waiters)]
+    await asyncio.sleep(0.1)  # Let every request register its waiter
+
+    start = time.perf_counter()
+    for i in range(waiters):
+        sent_at[f'req{i}'] = time.perf_counter()
+        with queue.lock:
+            queue.bodies.append((f'img{i}.jpg:person{i % 100}', f'req{i}'))
+    latencies = sorted(await asyncio.gather(*requests))
+    elapsed = time.perf_counter() - start
+    poller.cancel()
+    return elapsed, latencies, queue.receives, dispatcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--waiters', type=int, default=10000)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    elapsed, latencies, receives, dispatcher = asyncio.run(run(args.waiters, args.timeout))
+    print(f"[INFO] {args.waiters} waiters woken in {elapsed:.2f}s "
+          f"({args.waiters / elapsed:.0f} results/s, {receives} receive calls)")
+    print(f"[INFO] latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms | "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms | max {latencies[-1] * 1000:.1f} ms")
+    print(f"[INFO] left behind: {len(dispatcher.waiters)} waiters, {len(dispatcher.orphans)} orphans | "
+          f"stats {dispatcher.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Hot-tier hit rate and latency on a skewed replay of custom/face_images_100.
+
+Embeds the 100 bundled test images once, then replays a Zipf-distributed request stream (a few
+images account for most requests) through FaceRecognizer.search with and without the hot tier.
+Random distractor rows can be appended to the gallery to emulate a large enrollment.
+
+    python benchmark_hot_tier.py --requests 5000 --zipf 1.2 --distractors 200000
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+import torch
+import torch.nn.functional as F
+
+from face_recognition import DATA_PATH, FaceRecognizer, load_image
+from gallery import Gallery, write_gallery
+
+IMAGE_GLOB = 'facenet_pytorch/custom/face_images_100/*.jpg'
+
+
+def zipf_stream(n_items, n_requests, exponent, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    weights = 1.0 / torch.arange(1, n_items + 1, dtype=torch.float).pow(exponent)
+    ranking = torch.randperm(n_items, generator=generator)
+    picks = torch.multinomial(weights, n_requests, replacement=True, generator=generator)
+    return ranking[picks].tolist()
+
+
+def replay(recognizer, queries, stream):
+    names = []
+    start = time.perf_counter()
+    for i in stream:
+        names.append(recognizer.search(queries[i])[0][0][0])
+    return (time.perf_counter() - start) / len(stream) * 1000, names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--gallery', default=DATA_PATH)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--zipf', type=float, default=1.1, help="Zipf exponent of the request mix")
+    parser.add_argument('--distractors', type=int, default=0)
+    parser.add_argument('--hot-size', type=int, default=64)
+    args = parser.parse_args()
+
+    gallery_path = args.gallery
+    if args.distractors:
+        base = Gallery.open(args.gallery)
+        extra = F.normalize(torch.randn(args.distractors, base.dim), dim=1)
+        gallery_path = os.path.join(tempfile.mkdtemp(prefix='hot_tier_bench_'), 'gallery')
+        write_gallery(
+            gallery_path, torch.cat([base.full.float(), extra]),
+            list(base.names) + [f'distractor{i}' for i in range(args.distractors)],
+        )
+
+    cold = FaceRecognizer(gallery_path, hot_tier_size=0)
+    hot = FaceRecognizer(gallery_path, hot_tier_size=args.hot_size)
+    paths = sorted(glob.glob(IMAGE_GLOB))
+    embeddings = cold.embed_many([load_image(path) for path in paths])
+    queries = [emb.unsqueeze(0) for emb in embeddings if emb is not None]
+    stream = zipf_stream(len(queries), args.requests, args.zipf)
+    print(f'{len(queries)} query faces, {len(cold.names)} gallery rows, {args.requests} requests')
+
+    cold_ms, cold_names = replay(cold, queries, stream)
+    hot_ms, hot_names = replay(hot, queries, stream)
+    agreement = sum(a == b for a, b in zip(cold_names, hot_names)) / len(stream)
+    print(f'{"search":>10} | {"ms/query":>9} | {"hit rate":>8} | {"agreement":>9}')
+    print(f'{"full":>10} | {cold_ms:9.3f} | {"-":>8} | {1.0:9.4f}')
+    print(f'{"hot tier":>10} | {hot_ms:9.3f} | {hot.stats()["hit_rate"]:8.3f} | {agreement:9.4f}')
+    print(hot.stats())
+
+
+if __name__ == '__main__':
+    main()
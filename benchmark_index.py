@@ -0,0 +1,85 @@
+"""Recall-vs-latency benchmark of the IVF index against exact search.
+
+Builds a synthetic gallery of L2-normalized 512-d embeddings (optionally seeded from the real
+embeddings of a data.pt with --seed-from), queries it with perturbed copies of enrolled rows
+and reports recall@k and per-query latency for a range of nprobe values.
+
+    python benchmark_index.py --size 200000 --queries 500 --k 5
+    python benchmark_index.py --size 200000 --seed-from data.pt
+"""
+
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+
+from ann_index import IVFIndex, NPROBE_STEPS, exact_search, perturb, recall_at_k
+from gallery import load_data_pt
+
+
+def synthetic_gallery(size, dim=512, seed=0, centres=None):
+    """Random identities with a little shared structure, like real face embeddings.
+
+    The shared structure is random, or drawn from centres (e.g. real embeddings) when given.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    n_groups = max(1, size // 1000)
+    if centres is None:
+        groups = F.normalize(torch.randn(n_groups, dim, generator=generator), dim=1)
+    else:
+        groups = F.normalize(centres[torch.randint(len(centres), (n_groups,), generator=generator)], dim=1)
+        dim = groups.shape[1]
+    members = groups[torch.randint(len(groups), (size,), generator=generator)]
+    return F.normalize(members + torch.randn(size, dim, generator=generator) * 0.06, dim=1)
+
+
+def time_per_query(fn, queries, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(queries)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--batch', action='store_true', help="Time all queries as one batch")
+    parser.add_argument('--seed-from', default=None, metavar='DATA_PT',
+                        help="Build the synthetic identities around the embeddings of this data.pt")
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    centres = load_data_pt(args.seed_from)[0] if args.seed_from else None
+    gallery = synthetic_gallery(args.size, centres=centres)
+    queries = perturb(gallery[torch.randperm(args.size)[:args.queries]], seed=1)
+
+    start = time.perf_counter()
+    index = IVFIndex.build(gallery, nlist=args.nlist)
+    print(f'Built {index.nlist} partitions over {index.ntotal} rows in {time.perf_counter() - start:.1f}s')
+
+    sq_norms = gallery.pow(2).sum(dim=1)
+
+    def run_exact(q):
+        if args.batch:
+            return exact_search(q, gallery, args.k, sq_norms)[1]
+        return torch.cat([exact_search(row, gallery, args.k, sq_norms)[1] for row in q])
+
+    exact_ms, exact_ids = time_per_query(run_exact, queries)
+    print(f'{"search":>12} | {"recall@" + str(args.k):>9} | {"ms/query":>9} | {"speedup":>7}')
+    print(f'{"exact":>12} | {1.0:9.4f} | {exact_ms:9.3f} | {1.0:7.1f}')
+
+    for nprobe in NPROBE_STEPS:
+        if nprobe > index.nlist:
+            break
+        approx_ms, approx_ids = time_per_query(lambda q: index.search(q, args.k, nprobe)[1], queries)
+        recall = recall_at_k(approx_ids, exact_ids)
+        print(f'{"nprobe=" + str(nprobe):>12} | {recall:9.4f} | {approx_ms:9.3f} | {exact_ms / approx_ms:7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Query latency of a sharded gallery versus shard count.
+
+Writes a synthetic gallery, splits it into 1, 2, 4, ... shards served by separate processes on
+Unix sockets, and times scatter-gather searches against in-process exact search.
+
+    python benchmark_shards.py --size 200000 --max-shards 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from ann_index import perturb, recall_at_k
+from benchmark_index import synthetic_gallery
+from gallery import Gallery, write_gallery
+from shards import ShardedGallery, split, start_servers
+
+
+def time_per_query(search, queries, batch):
+    start = time.perf_counter()
+    ids = [search(queries[i:i + batch])[1] for i in range(0, len(queries), batch)]
+    return (time.perf_counter() - start) / len(queries) * 1000, torch.cat(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=1, help="Queries per search call")
+    parser.add_argument('--max-shards', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    work_dir = tempfile.mkdtemp(prefix='shards_bench_')
+    path = os.path.join(work_dir, 'gallery')
+    embeddings = synthetic_gallery(args.size)
+    write_gallery(path, embeddings, [f'id{i}' for i in range(args.size)])
+    queries = perturb(embeddings[torch.randperm(args.size)[:args.queries]], seed=1)
+
+    local = Gallery.open(path)
+    local_ms, exact_ids = time_per_query(lambda q: local.search(q, args.k), queries, args.batch)
+    print(f'{"shards":>8} | {"ms/query":>9} | {"recall@" + str(args.k):>9}')
+    print(f'{"local":>8} | {local_ms:9.3f} | {1.0:9.4f}')
+
+    n_shards = 1
+    while n_shards <= args.max_shards:
+        manifest = split(path, n_shards, work_dir)
+        servers = start_servers(manifest)
+        sharded = ShardedGallery(manifest)
+        sharded.search(queries[:1], args.k)  # Warm up connections and page in the shards
+        shard_ms, shard_ids = time_per_query(lambda q: sharded.search(q, args.k), queries, args.batch)
+        print(f'{n_shards:>8} | {shard_ms:9.3f} | {recall_at_k(shard_ids, exact_ids):9.4f}')
+        sharded.close()
+        for server in servers:
+            server.terminate()
+            server.join()
+        n_shards *= 2
+
+
+if __name__ == '__main__':
+    main()
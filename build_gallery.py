@@ -0,0 +1,234 @@
+"""Parallel, resumable gallery build over an ImageFolder dataset (one sub-folder per person).
+
+DataLoader worker processes read, hash, decode and run MTCNN on chunks of files, batching
+same-size images together. The main process embeds the crops in large InceptionResnetV1
+batches. Progress is checkpointed as shards in a work directory, so an interrupted build
+resumes where it stopped. Files whose content hash is already in a shard are skipped, so
+re-running after adding images only processes the new ones.
+
+Rebuilding a gallery directory that may be served swaps a new directory in with the next
+generation number, so LiveGallery readers reload it. Identities already in the gallery but not
+in image_root (enrolled through the log, whether compacted or not) are carried over into the new
+base; --drop-missing drops them instead.
+
+    python build_gallery.py facenet_pytorch/data/test_images gallery --workers 8
+    python build_gallery.py facenet_pytorch/data/test_images data.pt   # legacy format
+"""
+
+import argparse
+import glob
+import hashlib
+import io
+import os
+import time
+from collections import defaultdict
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from torchvision import datasets
+
+from face_recognition import mtcnn, resnet
+from enrollment import gallery_lock, log_path, read_log
+from gallery import DTYPES, Gallery, write_gallery
+
+MIN_PROB = 0.90  # Minimum detection probability for a face to be enrolled
+
+
+def file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class FaceChunks(Dataset):
+    """Each item is a chunk of ImageFolder samples, read, hashed, decoded and detected together."""
+
+    def __init__(self, samples, classes, chunk_size, done_hashes, min_prob=MIN_PROB):
+        self.samples = samples
+        self.classes = classes
+        self.chunks = [
+            list(range(i, min(i + chunk_size, len(samples))))
+            for i in range(0, len(samples), chunk_size)
+        ]
+        self.done_hashes = done_hashes
+        self.min_prob = min_prob
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, i):
+        by_size = defaultdict(list)
+        rejected = []
+        for idx in self.chunks[i]:
+            path, label = self.samples[idx]
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = file_hash(data)
+            if digest in self.done_hashes:
+                continue
+            try:
+                img = Image.open(io.BytesIO(data)).convert('RGB')
+            except Exception as e:
+                print(f"[ERROR] Failed to decode {path}: {e}")
+                rejected.append(digest)
+                continue
+            by_size[img.size].append((img, self.classes[label], digest))
+
+        faces, names, hashes = [], [], []
+        with torch.no_grad():
+            for items in by_size.values():
+                crops, probs = mtcnn([img for img, _, _ in items], return_prob=True)
+                for (_, name, digest), crop, prob in zip(items, crops, probs):
+                    if crop is not None and prob[0] > self.min_prob:
+                        faces.append(crop)
+                        names.append(name)
+                        hashes.append(digest)
+                    else:
+                        rejected.append(digest)
+
+        return {
+            'faces': torch.stack(faces) if faces else None,
+            'names': names,
+            'hashes': hashes,
+            'rejected': rejected,
+        }
+
+
+def _init_worker(_):
+    # Each worker gets one intra-op thread so N workers use N cores without oversubscription
+    torch.set_num_threads(1)
+
+
+def load_shards(work_dir):
+    """Returns the shards written so far, in order."""
+    return [torch.load(path) for path in sorted(glob.glob(os.path.join(work_dir, 'shard_*.pt')))]
+
+
+def save_shard(work_dir, number, shard):
+    path = os.path.join(work_dir, f'shard_{number:06d}.pt')
+    torch.save(shard, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def embed(faces, batch_size):
+    with torch.inference_mode():
+        return torch.cat([resnet(faces[i:i + batch_size]) for i in range(0, len(faces), batch_size)])
+
+
+def build(
+    image_root, output, work_dir=None, workers=None, chunk_size=16, embed_batch=128,
+    checkpoint_every=64, dtype='fp32', min_prob=MIN_PROB, carry_over=True
+):
+    """Builds a gallery directory (or a legacy data.pt if output ends in .pt) from image_root."""
+    work_dir = work_dir or output.rstrip(os.sep) + '.build'
+    workers = os.cpu_count() if workers is None else workers
+    os.makedirs(work_dir, exist_ok=True)
+
+    shards = load_shards(work_dir)
+    done_hashes = set()
+    for shard in shards:
+        done_hashes.update(shard['hashes'])
+        done_hashes.update(shard['rejected'])
+
+    dataset = datasets.ImageFolder(image_root)
+    chunks = FaceChunks(dataset.samples, dataset.classes, chunk_size, done_hashes, min_prob)
+    loader = DataLoader(
+        chunks, batch_size=None, num_workers=workers, worker_init_fn=_init_worker,
+    )
+    print(f"[INFO] {len(dataset.samples)} images, {len(done_hashes)} already processed, "
+          f"{workers} workers")
+
+    start = time.time()
+    pending = {'faces': [], 'names': [], 'hashes': [], 'rejected': []}
+    processed = 0
+
+    def checkpoint():
+        faces = [f for f in pending['faces'] if f is not None]
+        shard = {
+            'embeddings': embed(torch.cat(faces), embed_batch) if faces else torch.empty(0, 512),
+            'names': pending['names'],
+            'hashes': pending['hashes'],
+            'rejected': pending['rejected'],
+        }
+        save_shard(work_dir, len(shards), shard)
+        shards.append(shard)
+        for key in pending:
+            pending[key] = []
+
+    for i, item in enumerate(loader):
+        # Duplicate files within this run are only enrolled once
+        keep = [j for j, digest in enumerate(item['hashes']) if digest not in done_hashes]
+        done_hashes.update(item['hashes'])
+        done_hashes.update(item['rejected'])
+        if keep:
+            pending['faces'].append(item['faces'][keep])
+            pending['names'].extend(item['names'][j] for j in keep)
+            pending['hashes'].extend(item['hashes'][j] for j in keep)
+        pending['rejected'].extend(item['rejected'])
+        processed += len(item['hashes']) + len(item['rejected'])
+
+        if (i + 1) % checkpoint_every == 0:
+            if pending['names'] or pending['rejected']:
+                checkpoint()
+            print(f"[INFO] {i + 1}/{len(chunks)} chunks, {processed} images, "
+                  f"{processed / (time.time() - start):.1f} images/s")
+    if pending['names'] or pending['rejected']:
+        checkpoint()
+
+    embeddings = torch.cat([shard['embeddings'] for shard in shards])
+    names = [name for shard in shards for name in shard['names']]
+    if output.endswith('.pt'):
+        torch.save([list(embeddings.split(1)), names], output + '.tmp')
+        os.replace(output + '.tmp', output)
+    else:
+        write_output(output, embeddings, names, dtype, carry_over)
+    print(f"[SUCCESS] Wrote {len(names)} embeddings to {output} in {time.time() - start:.1f}s")
+    return len(names)
+
+
+def write_output(output, embeddings, names, dtype, carry_over=True):
+    """Swaps the built gallery in as the next generation of output.
+
+    With carry_over, rows of the current gallery (base and enrollment log) whose identity is
+    not among the built names are kept, so enrolled people survive a rebuild.
+    """
+    output = output.rstrip(os.sep)
+    with gallery_lock(output):
+        generation = 0
+        if os.path.isdir(output):
+            base = Gallery.open(output)
+            generation = base.generation + 1
+            enrolled, enrolled_embeddings, _ = read_log(log_path(output))
+            if carry_over:
+                built = set(names)
+                old_names = list(base.names) + enrolled
+                keep = [i for i, name in enumerate(old_names) if name not in built]
+                if keep:
+                    old = base.full.float()
+                    if enrolled:
+                        old = torch.cat([old, enrolled_embeddings])
+                    print(f"[INFO] Carrying over {len(keep)} rows of identities not in the image folder")
+                    embeddings = torch.cat([embeddings, old[torch.tensor(keep)]])
+                    names = names + [old_names[i] for i in keep]
+            elif enrolled:
+                print(f"[WARNING] Dropping {len(enrolled)} enrolled rows not in the image folder")
+        write_gallery(output, embeddings, names, dtype, generation)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a face gallery from an ImageFolder.")
+    parser.add_argument('image_root', help="Folder with one sub-folder of images per person")
+    parser.add_argument('output', help="Gallery directory, or a .pt path for the legacy format")
+    parser.add_argument('--work-dir', default=None, help="Checkpoint directory (default: <output>.build)")
+    parser.add_argument('--workers', type=int, default=None, help="DataLoader workers (default: all cores)")
+    parser.add_argument('--chunk-size', type=int, default=16, help="Images per worker task")
+    parser.add_argument('--embed-batch', type=int, default=128)
+    parser.add_argument('--checkpoint-every', type=int, default=64, help="Chunks between checkpoints")
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='fp32')
+    parser.add_argument('--min-prob', type=float, default=MIN_PROB)
+    parser.add_argument('--drop-missing', action='store_true',
+                        help="Drop identities of the existing gallery that are not in image_root")
+    args = parser.parse_args()
+
+    build(
+        args.image_root, args.output, args.work_dir, args.workers, args.chunk_size,
+        args.embed_batch, args.checkpoint_every, args.dtype, args.min_prob, not args.drop_missing,
+    )
@@ -0,0 +1,176 @@
+"""Startup calibration of worker processes, torch threads per process and micro-batch size.
+
+A few (processes, threads, batch size) configurations are benchmarked on the bundled sample
+images. The highest-throughput configuration whose p95 batch latency meets the latency target
+is kept. The choice is saved in a profile keyed by the hardware, so later boots on the same
+instance type reuse it without calibrating again. The profile lives outside the working tree
+(WORKER_PROFILE_PATH, by default under ~/.cache); backend.py also shares it between instances
+through S3.
+
+    python calibration.py --latency-target 2.0 --seconds 3
+    python calibration.py --force            # ignore the cached profile
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import time
+import torch
+
+from face_recognition import face_match_many, get_recognizer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_GLOB = os.path.join(ROOT, 'facenet_pytorch/custom/face_images_100/*.jpg')
+PROFILE_PATH = os.environ.get(
+    'WORKER_PROFILE_PATH', os.path.expanduser('~/.cache/face-worker/worker_profile.json')
+)
+LATENCY_TARGET = 2.0  # p95 seconds per micro-batch
+CALIBRATION_SECONDS = 3.0  # Measured run time per configuration
+BATCH_SIZES = (1, 4, 10)  # SQS delivers at most 10 messages per receive
+
+
+def hardware_fingerprint():
+    """Identifies the instance type: core count, CPU model and memory."""
+    model = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            model = next(
+                (line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), model
+            )
+    except OSError:
+        pass
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**30
+    return f"{os.cpu_count()} x {model}, {memory} GiB"
+
+
+def candidate_configs(cpus=None, batch_sizes=BATCH_SIZES):
+    """(processes, threads, batch size) triples: powers of two up to one process per core,
+    each process getting an equal share of the cores.
+    """
+    cpus = cpus or os.cpu_count()
+    counts = sorted({1, cpus} | {2 ** i for i in range(1, cpus.bit_length()) if 2 ** i < cpus})
+    return [(n, max(1, cpus // n), batch) for n in counts for batch in batch_sizes]
+
+
+def _run(images, threads, batch_size, seconds, results):
+    torch.set_num_threads(threads)
+    face_match_many(images[:batch_size])  # Warm-up, not timed
+    latencies, done = [], 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        batch = [images[(done + i) % len(images)] for i in range(batch_size)]
+        t = time.perf_counter()
+        face_match_many(batch)
+        latencies.append(time.perf_counter() - t)
+        done += batch_size
+    results.put((done / (time.perf_counter() - start), latencies))
+
+
+def measure(images, processes, threads, batch_size, seconds=CALIBRATION_SECONDS):
+    """Returns (images per second, p95 batch latency) of one configuration, or None on failure."""
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [
+        context.Process(target=_run, args=(images, threads, batch_size, seconds, results), daemon=True)
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        outputs = [results.get(timeout=60 + 20 * seconds) for _ in workers]
+    except queue.Empty:
+        for worker in workers:
+            worker.terminate()
+        return None
+    finally:
+        for worker in workers:
+            worker.join()
+
+    latencies = sorted(latency for _, worker_latencies in outputs for latency in worker_latencies)
+    return sum(rate for rate, _ in outputs), latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def calibrate(latency_target=LATENCY_TARGET, seconds=CALIBRATION_SECONDS, sample_glob=SAMPLE_GLOB):
+    """Benchmarks every candidate configuration and returns the chosen profile."""
+    images = []
+    for path in sorted(glob.glob(sample_glob)):
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    if not images:
+        raise FileNotFoundError(f"No calibration images match {sample_glob}")
+    get_recognizer()  # Loaded once here and shared with the forked benchmark processes
+
+    runs = []
+    for processes, threads, batch_size in candidate_configs():
+        result = measure(images, processes, threads, batch_size, seconds)
+        if result is None:
+            print(f"[ERROR] processes={processes} threads={threads} batch={batch_size}: no result")
+            continue
+        throughput, p95 = result
+        print(f"[INFO] processes={processes} threads={threads} batch={batch_size}: "
+              f"{throughput:.1f} images/s, p95 {p95:.2f}s")
+        runs.append({
+            'processes': processes, 'threads': threads, 'batch_size': batch_size,
+            'throughput': throughput, 'p95_latency': p95,
+        })
+    if not runs:
+        raise RuntimeError("Calibration produced no results")
+
+    meeting = [run for run in runs if run['p95_latency'] <= latency_target]
+    if meeting:
+        best = max(meeting, key=lambda run: run['throughput'])
+    else:
+        print(f"[WARNING] No configuration meets the {latency_target}s latency target")
+        best = min(runs, key=lambda run: run['p95_latency'])
+    return dict(best, hardware=hardware_fingerprint(), latency_target=latency_target)
+
+
+def load_profile(path=PROFILE_PATH, latency_target=LATENCY_TARGET):
+    """Returns the cached profile if it was calibrated on this hardware for this target."""
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get('hardware') != hardware_fingerprint() or profile.get('latency_target') != latency_target:
+        return None
+    return profile
+
+
+def load_or_calibrate(path=PROFILE_PATH, latency_target=LATENCY_TARGET, seconds=CALIBRATION_SECONDS,
+                      force=False):
+    """Returns the cached profile for this hardware, calibrating and saving one if needed."""
+    profile = None if force else load_profile(path, latency_target)
+    if profile is not None:
+        print(f"[INFO] Using cached worker profile {path}")
+        return profile
+
+    start = time.time()
+    profile = calibrate(latency_target, seconds)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(path + '.tmp', path)
+    print(f"[SUCCESS] Calibrated in {time.time() - start:.0f}s -> {path}")
+    return profile
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Calibrate worker processes, threads and batch size.")
+    parser.add_argument('--profile', default=PROFILE_PATH)
+    parser.add_argument('--latency-target', type=float, default=LATENCY_TARGET,
+                        help="Maximum p95 seconds per micro-batch")
+    parser.add_argument('--seconds', type=float, default=CALIBRATION_SECONDS,
+                        help="Measured run time per configuration")
+    parser.add_argument('--force', action='store_true', help="Recalibrate even if a profile exists")
+    args = parser.parse_args()
+
+    profile = load_or_calibrate(args.profile, args.latency_target, args.seconds, args.force)
+    print(f"[INFO] processes={profile['processes']} threads={profile['threads']} "
+          f"batch={profile['batch_size']}: {profile['throughput']:.1f} images/s, "
+          f"p95 {profile['p95_latency']:.2f}s")
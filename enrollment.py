@@ -0,0 +1,257 @@
+"""Append-only enrollment for gallery directories, with compaction and hot reload.
+
+New identities are appended as records to <gallery>/enroll.log instead of rewriting the embedding
+matrix. A LiveGallery serves the memory-mapped base gallery plus the rows found in the log, and
+refresh() picks up new records without touching the base. Compaction folds the log into a new
+base gallery with the next generation number and swaps the directory in place; readers that
+still hold the old gallery keep their memory maps until they release them.
+
+    python enrollment.py enroll gallery "Jane Doe" jane_1.jpg jane_2.jpg
+    python enrollment.py compact gallery
+"""
+
+import json
+import os
+import struct
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+from ann_index import merge_results
+from gallery import Gallery, write_gallery
+
+LOG_NAME = 'enroll.log'
+RECORD_MAGIC = b'ENRL'
+RECORD_HEADER = struct.Struct('<4sII')  # magic, name length in bytes, embedding dimension
+COMPACT_THRESHOLD = 10000  # Pending log rows that trigger compaction after an enrollment
+
+
+def log_path(gallery_path):
+    return os.path.join(gallery_path, LOG_NAME)
+
+
+@contextmanager
+def gallery_lock(gallery_path):
+    """Serialises writers (enrollment and compaction) of one gallery across processes.
+
+    POSIX only; fcntl is imported here so that serving a gallery works everywhere.
+    """
+    import fcntl
+
+    with open(gallery_path.rstrip(os.sep) + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_log(path, offset=0):
+    """Reads complete records from byte offset onwards.
+
+    Returns (names, embeddings, end_offset), where embeddings is an M x D tensor or None. A torn
+    record at the end of the log (from a writer that crashed mid-append) is not returned.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], None, offset
+
+    names, rows = [], []
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        magic, name_len, dim = RECORD_HEADER.unpack_from(data, pos)
+        name_start = pos + RECORD_HEADER.size
+        end = name_start + name_len + 4 * dim
+        if magic != RECORD_MAGIC or end > len(data):
+            break
+        names.append(data[name_start:name_start + name_len].decode('utf-8'))
+        rows.append(np.frombuffer(data, np.float32, dim, name_start + name_len))
+        pos = end
+
+    embeddings = torch.from_numpy(np.stack(rows)) if rows else None
+    return names, embeddings, offset + pos
+
+
+def enroll(gallery_path, name, embeddings):
+    """Appends one log record per embedding row for name. Returns the number of pending rows."""
+    if not os.path.isdir(gallery_path):
+        raise ValueError(
+            f"{gallery_path} is not a gallery directory; convert it with `python gallery.py convert`"
+        )
+    dim = Gallery.open(gallery_path).dim
+    rows = embeddings.detach().float().cpu().reshape(-1, dim).numpy()
+    encoded = name.encode('utf-8')
+    records = b''.join(
+        RECORD_HEADER.pack(RECORD_MAGIC, len(encoded), dim) + encoded + row.tobytes()
+        for row in rows
+    )
+
+    with gallery_lock(gallery_path):
+        path = log_path(gallery_path)
+        names, _, valid_end = read_log(path)
+        with open(path, 'ab') as f:
+            f.truncate(valid_end)
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+    return len(names) + len(rows)
+
+
+def compact(gallery_path):
+    """Folds the enrollment log into a new base gallery. Returns the number of rows folded in."""
+    gallery_path = gallery_path.rstrip(os.sep)
+    with gallery_lock(gallery_path):
+        base = Gallery.open(gallery_path)
+        names, embeddings, _ = read_log(log_path(gallery_path))
+        if not names:
+            return 0
+
+        # Swapped in as a new directory without the log
+        write_gallery(
+            gallery_path,
+            torch.cat([base.full.float(), embeddings]),
+            list(base.names) + names,
+            base.dtype,
+            base.generation + 1,
+        )
+    return len(names)
+
+
+def _read_generation(gallery_path):
+    with open(os.path.join(gallery_path, 'meta.json')) as f:
+        return json.load(f).get('generation', 0)
+
+
+class _ConcatNames:
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def __len__(self):
+        return len(self.first) + len(self.second)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < len(self.first):
+            return self.first[i]
+        return self.second[i - len(self.first)]
+
+    def __iter__(self):
+        yield from self.first
+        yield from self.second
+
+
+class LiveGallery:
+    """A base Gallery plus the rows enrolled in its log since the base was written.
+
+    Base rows keep ids 0..N-1 and enrolled rows follow them. Instances are never mutated:
+    refresh() returns a new LiveGallery, so a search that already holds one is unaffected.
+    """
+
+    def __init__(self, path, base, delta=None, log_offset=0):
+        self.path = path
+        self.base = base
+        self.delta = delta
+        self.log_offset = log_offset
+        self.names = _ConcatNames(base.names, delta.names if delta is not None else [])
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def dim(self):
+        return self.base.dim
+
+    @property
+    def generation(self):
+        return self.base.generation
+
+    @classmethod
+    def open(cls, path):
+        base = Gallery.open(path)
+        if not os.path.isdir(path):
+            return cls(path, base)
+        names, embeddings, offset = read_log(log_path(path))
+        delta = Gallery.from_tensors(embeddings, names) if names else None
+        return cls(path, base, delta, offset)
+
+    def refresh(self):
+        """Returns a LiveGallery reflecting on-disk changes, or self if nothing changed."""
+        if not os.path.isdir(self.path):
+            return self
+        try:
+            generation = _read_generation(self.path)
+            if generation == self.generation:
+                names, embeddings, offset = read_log(log_path(self.path), self.log_offset)
+                generation = _read_generation(self.path)
+            if generation != self.generation:
+                return LiveGallery.open(self.path)
+        except (OSError, ValueError):
+            # The directory is being swapped by a compaction; try again on the next poll
+            return self
+
+        if not names:
+            return self
+        if self.delta is not None:
+            embeddings = torch.cat([self.delta.embeddings, embeddings])
+            names = list(self.delta.names) + names
+        return LiveGallery(self.path, self.base, Gallery.from_tensors(embeddings, names), offset)
+
+    def vectors(self, ids):
+        """Returns the full-precision rows for the given ids."""
+        return torch.stack([
+            self.base.full[i] if i < len(self.base) else self.delta.full[i - len(self.base)]
+            for i in ids.tolist()
+        ]).float()
+
+    def search(self, queries, k=1, index=None, nprobe=None):
+        """Returns (distances, ids) of the k closest rows across the base and enrolled rows.
+
+        The base rows are searched through index when it was built over this base gallery.
+        """
+        if index is not None and index.ntotal == len(self.base):
+            results = [index.search(queries, k, nprobe)]
+        else:
+            results = [self.base.search(queries, k)]
+        if self.delta is not None:
+            dists, ids = self.delta.search(queries, k)
+            results.append((dists, ids + len(self.base)))
+        return merge_results(results, k)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Enroll identities into a gallery directory.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    enroll_parser = subparsers.add_parser('enroll', help="Append a person to the enrollment log")
+    enroll_parser.add_argument('gallery')
+    enroll_parser.add_argument('name')
+    enroll_parser.add_argument('images', nargs='+')
+    compact_parser = subparsers.add_parser('compact', help="Fold the enrollment log into the gallery")
+    compact_parser.add_argument('gallery')
+    args = parser.parse_args()
+
+    if args.command == 'enroll':
+        from PIL import Image
+        from face_recognition import mtcnn, resnet
+
+        rows = []
+        with torch.inference_mode():
+            for image_path in args.images:
+                face = mtcnn(Image.open(image_path))
+                if face is None:
+                    print(f"[ERROR] No face detected in {image_path}")
+                    continue
+                rows.append(resnet(face.unsqueeze(0)))
+        if rows:
+            pending = enroll(args.gallery, args.name, torch.cat(rows))
+            print(f"[SUCCESS] Enrolled {args.name} ({len(rows)} images, {pending} rows pending)")
+            if pending >= COMPACT_THRESHOLD:
+                print(f"[INFO] Compacted {compact(args.gallery)} rows into {args.gallery}")
+    else:
+        print(f"[SUCCESS] Compacted {compact(args.gallery)} rows into {args.gallery}")
@@ -1,31 +1,295 @@
 __copyright__   = "Copyright 2025, VISA Lab"
 __license__     = "MIT"
 
+import hashlib
+import io
 import os
 import csv
 import sys
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from PIL import Image
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from torchvision import datasets
 from torch.utils.data import DataLoader
+from ann_index import load_index
+from enrollment import LiveGallery
+from shards import MANIFEST_SUFFIX, ShardedGallery
+from hot_tier import HOT_TIER_SIZE, HotTier
 
-mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20) 
-resnet = InceptionResnetV1(pretrained='vggface2').eval() 
+DATA_PATH = 'data.pt'  # data.pt, a gallery directory (gallery.py) or a shard manifest (shards.py)
+INDEX_PATH = None  # Optional IVF (ann_index.py) or prototype (prototypes.py) index
+RECALL_TARGET = 0.95  # Recall@k the IVF index is probed for
+RELOAD_INTERVAL = 2.0  # Seconds between checks for new enrollments (None disables)
+DECODE_WORKERS = 4  # Threads decoding images for batched matching
+BATCH_SIZE = 64  # Maximum images per MTCNN batch and faces per InceptionResnetV1 batch
+FINGERPRINT_ROWS = 64  # Gallery rows hashed into the content fingerprint of its version
 
-def face_match(image_path): 
-    img = Image.open(image_path)
-    face, _ = mtcnn(img, return_prob=True)
-    emb = resnet(face.unsqueeze(0)).detach() 
+mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20)
+mtcnn_all = MTCNN(image_size=240, margin=0, min_face_size=20, keep_all=True)
+resnet = InceptionResnetV1(pretrained='vggface2').eval()
 
-    saved_data = torch.load('data.pt') 
-    embedding_list = saved_data[0] 
-    name_list = saved_data[1] 
-    dist_list = [] 
+class FaceRecognizer:
+    """Matches faces against a gallery that is loaded once and kept resident.
 
-    for idx, emb_db in enumerate(embedding_list):
-        dist = torch.dist(emb, emb_db).item()
-        dist_list.append(dist)
+    Distances to every identity are computed with a single matrix product instead of one
+    torch.dist call per gallery entry, and detection/embedding run under inference mode. When
+    an IVF index is given, only the partitions needed to reach recall_target are scanned; a
+    prototype index scans per-identity prototypes instead of every enrolled row.
+    Enrollments and compactions of a gallery directory are swapped in by refresh(). Top-1
+    searches first try a small hot tier of frequently matched rows (see hot_tier.py).
+    """
 
-    idx_min = dist_list.index(min(dist_list))
-    return (name_list[idx_min], min(dist_list))
+    def __init__(
+        self, data_path=DATA_PATH, detector=None, embedder=None, index_path=None,
+        recall_target=RECALL_TARGET, multi_detector=None, hot_tier_size=HOT_TIER_SIZE
+    ):
+        self.mtcnn = detector if detector is not None else mtcnn
+        self.mtcnn_all = multi_detector if multi_detector is not None else mtcnn_all
+        self.resnet = embedder if embedder is not None else resnet
+        if data_path.endswith(MANIFEST_SUFFIX):
+            if index_path is not None:
+                raise ValueError("Indexes are not supported on sharded galleries")
+            self.gallery = ShardedGallery(data_path)
+        else:
+            self.gallery = LiveGallery.open(data_path)
+        self.decode_pool = ThreadPoolExecutor(DECODE_WORKERS)
+        self.hot_tier = HotTier(hot_tier_size) if hot_tier_size else None
+        self.watch_interval = None
+        self._version = None  # (gallery, version) of the gallery the version was computed for
+
+        self.index = None
+        self.nprobe = None
+        if index_path is not None:
+            self.index = load_index(index_path, self.gallery.base.full)
+            if self.index.ntotal != len(self.gallery.base):
+                raise ValueError(
+                    f"Index {index_path} holds {self.index.ntotal} rows, "
+                    f"gallery has {len(self.gallery.base)}"
+                )
+            if hasattr(self.index, 'nprobe_for_recall'):
+                self.nprobe = self.index.nprobe_for_recall(recall_target)
+
+    @property
+    def names(self):
+        return self.gallery.names
+
+    @property
+    def version(self):
+        """(generation, rows, fingerprint) of the current gallery.
+
+        Generation and rows grow with every enrollment and compaction; the fingerprint hashes a
+        sample of rows and names, so a regenerated gallery of the same size differs as well.
+        """
+        gallery = self.gallery
+        if self._version is None or self._version[0] is not gallery:
+            rows = len(gallery)
+            digest = hashlib.sha1()
+            if rows:
+                ids = torch.linspace(0, rows - 1, min(rows, FINGERPRINT_ROWS)).long()
+                digest.update(gallery.vectors(ids).float().numpy().tobytes())
+                digest.update('\n'.join(gallery.names[i] for i in ids.tolist()).encode('utf-8'))
+            self._version = (gallery, (getattr(gallery, 'generation', 0), rows, digest.hexdigest()[:12]))
+        return self._version[1]
+
+    def refresh(self):
+        """Swaps in on-disk gallery changes. Searches already running keep their gallery."""
+        gallery = self.gallery.refresh()
+        if gallery is self.gallery:
+            return False
+        if self.index is not None and self.index.ntotal != len(gallery.base):
+            print("[WARNING] IVF index does not cover the compacted gallery; using exact search")
+        self.gallery = gallery
+        if self.hot_tier is not None:
+            self.hot_tier.clear(gallery)
+        print(f"[INFO] Gallery reloaded: {len(gallery)} rows (generation {gallery.generation})")
+        return True
+
+    def watch(self, interval=RELOAD_INTERVAL):
+        """Starts a daemon thread that calls refresh() every interval seconds."""
+        self.watch_interval = interval
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[ERROR] Gallery reload failed: {e}")
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def after_fork(self):
+        """Threads and sockets cannot be shared across fork(): gives a child process its own
+        decode pool, watcher and shard connections.
+        """
+        if hasattr(self.gallery, 'reopen'):
+            self.gallery.reopen()
+        self.decode_pool = ThreadPoolExecutor(DECODE_WORKERS)
+        if self.watch_interval is not None:
+            self.watch(self.watch_interval)
+
+    def embed(self, img):
+        """Returns the 1 x 512 embedding of the face in img, or None if no face is found."""
+        with torch.inference_mode():
+            face, _ = self.mtcnn(img, return_prob=True)
+            if face is None:
+                return None
+            return self.resnet(face.unsqueeze(0))
+
+    def embed_all(self, img):
+        """Returns (boxes, embeddings) for every face in img: an n x 4 array and an n x 512 tensor."""
+        with torch.inference_mode():
+            boxes, _ = self.mtcnn_all.detect(img)
+            if boxes is None:
+                return None, None
+            faces = self.mtcnn_all.extract(img, boxes, None)
+            return boxes, self.resnet(faces)
+
+    def embed_many(self, imgs):
+        """Returns one 512-d embedding (or None if no face is found) per image.
+
+        Images of equal size go through MTCNN together and all detected faces are embedded in
+        batches of up to BATCH_SIZE.
+        """
+        by_size = defaultdict(list)
+        for i, img in enumerate(imgs):
+            if img is not None:
+                by_size[img.size].append(i)
+
+        faces = [None] * len(imgs)
+        with torch.inference_mode():
+            for idxs in by_size.values():
+                for start in range(0, len(idxs), BATCH_SIZE):
+                    chunk = idxs[start:start + BATCH_SIZE]
+                    crops, _ = self.mtcnn([imgs[i] for i in chunk], return_prob=True)
+                    for i, crop in zip(chunk, crops):
+                        faces[i] = crop
+
+            found = [i for i, face in enumerate(faces) if face is not None]
+            embeddings = [None] * len(imgs)
+            for start in range(0, len(found), BATCH_SIZE):
+                chunk = found[start:start + BATCH_SIZE]
+                batch = self.resnet(torch.stack([faces[i] for i in chunk]))
+                for i, emb in zip(chunk, batch):
+                    embeddings[i] = emb
+        return embeddings
+
+    def search(self, emb, k=1):
+        """Returns (names, distances) of the k closest identities for each row of emb."""
+        gallery = self.gallery
+        hot_tier = self.hot_tier if k == 1 else None
+        with torch.inference_mode():
+            emb = emb.reshape(-1, emb.shape[-1]).float()
+            hot = hot_tier.search(emb, gallery) if hot_tier is not None else [None] * len(emb)
+            rows = [[(result[1], result[0])] if result is not None else None for result in hot]
+            cold = [q for q, result in enumerate(hot) if result is None]
+            if cold:
+                dists, ids = gallery.search(emb[cold], k, self.index, self.nprobe)
+                for q, id_row, dist_row in zip(cold, ids.tolist(), dists.tolist()):
+                    rows[q] = [(i, d) for i, d in zip(id_row, dist_row) if i >= 0]
+        if hot_tier is not None:
+            hot_tier.record([hits[0][0] for hits in rows if hits], gallery)
+
+        names = [[gallery.names[i] for i, _ in hits] for hits in rows]
+        distances = [[d for _, d in hits] for hits in rows]
+        return names, distances
+
+    def stats(self):
+        """Hot-tier counters: hot rows, lookups, hits, misses and hit rate."""
+        return self.hot_tier.stats() if self.hot_tier is not None else {}
+
+    def match(self, image, k=1):
+        """Returns the k closest (name, distance) pairs for the face in an image.
+
+        image is a path, encoded image bytes, a binary file object or a PIL image.
+        """
+        img = open_image(image)
+        emb = self.embed(img)
+        if emb is None:
+            raise ValueError("No face detected")
+        names, dists = self.search(emb, k)
+        if not names[0]:
+            raise ValueError("No gallery match found")
+        return list(zip(names[0], dists[0]))
+
+    def match_faces(self, image, k=1):
+        """Matches every face in an image (path, bytes, file object or PIL image).
+
+        Returns a list of (box, matches) per detected face, largest face first, where box is
+        [x1, y1, x2, y2] and matches holds the k closest (name, distance) pairs.
+        """
+        img = open_image(image)
+        boxes, embeddings = self.embed_all(img)
+        if boxes is None:
+            return []
+        names, dists = self.search(embeddings, k)
+        return [
+            (box.tolist(), list(zip(row_names, row_dists)))
+            for box, row_names, row_dists in zip(boxes, names, dists)
+        ]
+
+    def match_many(self, images, k=1):
+        """Matches a list of images (paths, bytes, file objects or PIL images) in batches.
+
+        Returns a list in input order holding the k closest (name, distance) pairs for each
+        image, or None for images that could not be decoded or contain no face.
+        """
+        imgs = list(self.decode_pool.map(load_image, images))
+        embeddings = self.embed_many(imgs)
+        found = [i for i, emb in enumerate(embeddings) if emb is not None]
+        results = [None] * len(images)
+        if found:
+            names, dists = self.search(torch.stack([embeddings[i] for i in found]), k)
+            for i, row_names, row_dists in zip(found, names, dists):
+                results[i] = list(zip(row_names, row_dists)) or None
+        return results
+
+
+def open_image(image):
+    """Opens a path, encoded image bytes or a binary file object; PIL images pass through."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(image))
+    if isinstance(image, (str, os.PathLike)) or hasattr(image, 'read'):
+        return Image.open(image)
+    return image
+
+def load_image(image):
+    """Decodes an image to RGB, or returns None if it cannot be decoded."""
+    try:
+        return open_image(image).convert('RGB')
+    except Exception as e:
+        source = image if isinstance(image, (str, os.PathLike)) else type(image).__name__
+        print(f"[ERROR] Failed to decode {source}: {e}")
+        return None
+
+
+_recognizer = None
+
+def get_recognizer():
+    """Returns the process-wide FaceRecognizer, loading the gallery on first use."""
+    global _recognizer
+    if _recognizer is None:
+        _recognizer = FaceRecognizer(DATA_PATH, index_path=INDEX_PATH, recall_target=RECALL_TARGET)
+        if RELOAD_INTERVAL is not None and os.path.isdir(DATA_PATH):
+            _recognizer.watch(RELOAD_INTERVAL)
+        if hasattr(os, 'register_at_fork'):  # POSIX only; elsewhere nothing is forked
+            os.register_at_fork(after_in_child=_recognizer.after_fork)
+    return _recognizer
+
+def face_match(image_path):
+    return get_recognizer().match(image_path, k=1)[0]
+
+def face_match_all(image_path):
+    """Multi-face face_match: a (box, name, distance) tuple for every face in the image."""
+    return [
+        (box, *matches[0])
+        for box, matches in get_recognizer().match_faces(image_path, k=1) if matches
+    ]
+
+def face_match_many(images):
+    """Batched face_match: one (name, distance) or None (no face) per image, in input order."""
+    return [matches[0] if matches else None for matches in get_recognizer().match_many(images)]
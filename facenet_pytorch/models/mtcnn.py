@@ -3,7 +3,7 @@ from torch import nn
 import numpy as np
 import os
 
-from .utils.detect_face import detect_face, extract_face
+from .utils.detect_face import detect_face, extract_face, batch_array
 
 
 class PNet(nn.Module):
@@ -336,9 +336,9 @@ class MTCNN(nn.Module):
                 boxes.append(box[:, :4])
                 probs.append(box[:, 4])
                 points.append(point)
-        boxes = np.array(boxes)
-        probs = np.array(probs)
-        points = np.array(points)
+        boxes = batch_array(boxes)
+        probs = batch_array(probs)
+        points = batch_array(points)
 
         if (
             not isinstance(img, (list, tuple)) and 
@@ -441,9 +441,9 @@ class MTCNN(nn.Module):
             selected_points.append(point)
 
         if batch_mode:
-            selected_boxes = np.array(selected_boxes)
-            selected_probs = np.array(selected_probs)
-            selected_points = np.array(selected_points)
+            selected_boxes = batch_array(selected_boxes)
+            selected_probs = batch_array(selected_probs)
+            selected_points = batch_array(selected_points)
         else:
             selected_boxes = selected_boxes[0]
             selected_probs = selected_probs[0][0]
@@ -180,11 +180,24 @@ def detect_face(imgs, minsize, pnet, rnet, onet, threshold, factor, device):
         batch_boxes.append(boxes[b_i_inds].copy())
         batch_points.append(points[b_i_inds].copy())
 
-    batch_boxes, batch_points = np.array(batch_boxes), np.array(batch_points)
+    batch_boxes, batch_points = batch_array(batch_boxes), batch_array(batch_points)
 
     return batch_boxes, batch_points
 
 
+def batch_array(items):
+    """Converts a list of per-image results to an array. If the images have different numbers of
+    detections, a 1D object array is returned, as numpy did implicitly before version 1.24.
+    """
+    try:
+        return np.array(items)
+    except ValueError:
+        out = np.empty(len(items), dtype=object)
+        for i, item in enumerate(items):
+            out[i] = item
+        return out
+
+
 def bbreg(boundingbox, reg):
     if reg.shape[1] == 1:
         reg = torch.reshape(reg, (reg.shape[2], reg.shape[3]))
@@ -0,0 +1,252 @@
+"""Face gallery storage: the legacy data.pt pickle and a compact, memory-mapped directory format.
+
+A gallery directory holds:
+    meta.json       -- format version, generation, row count, dimension and storage dtype
+    embeddings.bin  -- N x D rows in the storage dtype (fp32, fp16 or int8)
+    scales.bin      -- N fp32 per-row scales (int8 only)
+    full.bin        -- N x D fp32 rows used to re-rank candidates (fp16/int8 only)
+    norms.bin       -- N fp32 squared L2 norms of the full-precision rows
+    names.bin       -- UTF-8 names, concatenated
+    names.idx       -- N + 1 int64 byte offsets into names.bin
+
+Every array is opened with numpy.memmap, so forked workers share the page cache instead of each
+holding a private copy, and rows of full.bin are only paged in for the candidates being re-ranked.
+A gallery is never rewritten in place: a new one is written next to it and renamed over it, so
+processes still mapping the old files keep reading them instead of faulting on truncated pages.
+
+    python gallery.py convert data.pt gallery --dtype int8
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import torch
+
+from ann_index import exact_search
+
+GALLERY_VERSION = 1
+DTYPES = {'fp32': np.float32, 'fp16': np.float16, 'int8': np.int8}
+RERANK_FACTOR = 10  # Candidates re-ranked at full precision per requested neighbour
+CHUNK_ROWS = 65536  # Quantized rows dequantized at a time while scanning
+
+
+def load_data_pt(data_path):
+    """Loads a data.pt gallery as a contiguous (N x 512) embedding matrix and a name list."""
+    saved_data = torch.load(data_path)
+    embedding_list = saved_data[0]
+    name_list = list(saved_data[1])
+    embeddings = torch.cat([emb.reshape(1, -1) for emb in embedding_list]).float().contiguous()
+    return embeddings, name_list
+
+
+def _memmap(path, dtype, shape):
+    # Copy-on-write keeps pages shared between processes while giving torch a writable view
+    if shape[0] == 0:
+        return torch.from_numpy(np.zeros(shape, dtype=dtype))
+    return torch.from_numpy(np.memmap(path, dtype=dtype, mode='c', shape=shape))
+
+
+class NameTable:
+    """Read-only sequence of names decoded on access from a memory-mapped offset table."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class Gallery:
+    """Enrolled embeddings and names, searchable by L2 distance.
+
+    `embeddings` holds the rows in their storage dtype. For fp16 and int8 storage the scan
+    ranks rows on the quantized values and the best `k * rerank` candidates are then re-scored
+    against the fp32 rows in `full`.
+    """
+
+    def __init__(
+        self, names, embeddings, sq_norms, full=None, scales=None, dtype='fp32', generation=0
+    ):
+        self.names = names
+        self.embeddings = embeddings
+        self.sq_norms = sq_norms
+        self.full = full if full is not None else embeddings
+        self.scales = scales
+        self.dtype = dtype
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @classmethod
+    def from_tensors(cls, embeddings, names):
+        embeddings = embeddings.float().contiguous()
+        return cls(list(names), embeddings, embeddings.pow(2).sum(dim=1))
+
+    @classmethod
+    def open(cls, path):
+        """Opens a gallery directory or, for backwards compatibility, a data.pt file."""
+        if not os.path.isdir(path):
+            return cls.from_tensors(*load_data_pt(path))
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != GALLERY_VERSION:
+            raise ValueError(f"Unsupported gallery version {meta.get('version')} in {path}")
+        count, dim, dtype = meta['count'], meta['dim'], meta['dtype']
+
+        names = NameTable(
+            _memmap(os.path.join(path, 'names.bin'), np.uint8, (meta['names_bytes'],)).numpy(),
+            _memmap(os.path.join(path, 'names.idx'), np.int64, (count + 1,)).numpy(),
+        )
+        embeddings = _memmap(os.path.join(path, 'embeddings.bin'), DTYPES[dtype], (count, dim))
+        sq_norms = _memmap(os.path.join(path, 'norms.bin'), np.float32, (count,))
+        full = scales = None
+        if dtype != 'fp32':
+            full = _memmap(os.path.join(path, 'full.bin'), np.float32, (count, dim))
+        if dtype == 'int8':
+            scales = _memmap(os.path.join(path, 'scales.bin'), np.float32, (count,))
+        return cls(names, embeddings, sq_norms, full, scales, dtype, meta.get('generation', 0))
+
+    def vectors(self, ids):
+        """Returns the full-precision rows for the given ids."""
+        return self.full[ids]
+
+    def _scan(self, queries, n_candidates):
+        """Ranks every row on its stored (possibly quantized) values, one chunk at a time."""
+        best_scores = best_ids = None
+        for start in range(0, len(self), CHUNK_ROWS):
+            block = self.embeddings[start:start + CHUNK_ROWS].float()
+            scores = queries @ block.t()
+            if self.scales is not None:
+                scores *= self.scales[start:start + CHUNK_ROWS]
+            # Maximising 2 q.v - ||v||^2 is minimising ||q - v||^2
+            scores = 2 * scores - self.sq_norms[start:start + CHUNK_ROWS]
+            scores, ids = scores.topk(min(n_candidates, scores.shape[1]), dim=1)
+            ids += start
+            if best_scores is not None:
+                scores = torch.cat([best_scores, scores], dim=1)
+                ids = torch.cat([best_ids, ids], dim=1)
+                scores, keep = scores.topk(min(n_candidates, scores.shape[1]), dim=1)
+                ids = ids.gather(1, keep)
+            best_scores, best_ids = scores, ids
+        return best_ids
+
+    def search(self, queries, k=1, rerank=RERANK_FACTOR):
+        """Returns (distances, ids) of the k closest rows for each query."""
+        queries = queries.reshape(-1, self.dim).float()
+        if self.dtype == 'fp32':
+            return exact_search(queries, self.embeddings, k, self.sq_norms)
+
+        k = min(k, len(self))
+        if k == 0 or len(queries) == 0:
+            # Nothing to scan (e.g. an empty base that rows are enrolled on top of)
+            return torch.empty(len(queries), k), torch.empty(len(queries), k, dtype=torch.long)
+        candidates = self._scan(queries, max(k, k * rerank))
+        distances, ids = [], []
+        for query, cand in zip(queries, candidates):
+            dists, top = exact_search(query, self.full[cand], k, self.sq_norms[cand])
+            distances.append(dists[0])
+            ids.append(cand[top[0]])
+        return torch.stack(distances), torch.stack(ids)
+
+
+def _write_array(path, array):
+    with open(path, 'wb') as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def write_gallery(path, embeddings, names, dtype='fp32', generation=0):
+    """Writes embeddings (N x D) and names to a gallery directory in the given storage dtype.
+
+    The gallery is written to a sibling directory and swapped in, replacing any existing one
+    (including its enrollment log) without touching files that live galleries have mapped.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {sorted(DTYPES)}, got {dtype!r}")
+    path = path.rstrip(os.sep)
+    tmp_path, old_path = f'{path}.tmp-{os.getpid()}', f'{path}.old-{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        _write_files(tmp_path, embeddings, names, dtype, generation)
+        if os.path.isdir(path):
+            os.rename(path, old_path)
+        elif os.path.exists(path):
+            raise FileExistsError(f"{path} exists and is not a gallery directory")
+        os.rename(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    # Unlinking is safe: mapped files stay readable until their last mapping goes away
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def _write_files(path, embeddings, names, dtype, generation):
+    full = embeddings.detach().float().cpu().numpy()
+
+    if dtype == 'int8':
+        scales = np.abs(full).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        _write_array(os.path.join(path, 'embeddings.bin'), np.round(full / scales[:, None]).astype(np.int8))
+        _write_array(os.path.join(path, 'scales.bin'), scales.astype(np.float32))
+    else:
+        _write_array(os.path.join(path, 'embeddings.bin'), full.astype(DTYPES[dtype]))
+    if dtype != 'fp32':
+        _write_array(os.path.join(path, 'full.bin'), full)
+    _write_array(os.path.join(path, 'norms.bin'), (full * full).sum(axis=1).astype(np.float32))
+
+    encoded = [name.encode('utf-8') for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+    _write_array(os.path.join(path, 'names.bin'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    _write_array(os.path.join(path, 'names.idx'), offsets)
+
+    meta = {
+        'version': GALLERY_VERSION,
+        'generation': generation,
+        'count': len(encoded),
+        'dim': full.shape[1],
+        'dtype': dtype,
+        'names_bytes': int(offsets[-1]),
+    }
+    # meta.json is written last so a partially written gallery is never opened
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def convert(data_path, path, dtype='fp32'):
+    """One-shot conversion of a legacy data.pt into a gallery directory."""
+    embeddings, names = load_data_pt(data_path)
+    write_gallery(path, embeddings, names, dtype)
+    return len(names)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage face gallery files.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help="Convert data.pt to a gallery directory")
+    convert_parser.add_argument('data_pt')
+    convert_parser.add_argument('output')
+    convert_parser.add_argument('--dtype', choices=sorted(DTYPES), default='fp32')
+    args = parser.parse_args()
+
+    count = convert(args.data_pt, args.output, args.dtype)
+    print(f"[SUCCESS] Converted {count} identities from {args.data_pt} -> {args.output} ({args.dtype})")
@@ -0,0 +1,103 @@
+"""Traffic-adaptive hot tier: the gallery rows matched most often recently, searched first.
+
+Match counts decay by half every `decay_every` recorded matches, so the hot set follows the
+current traffic rather than all-time totals. Counts and the snapshot belong to one gallery object;
+searches and matches against any other gallery (e.g. one still running after a reload) are ignored. A hot-tier answer is only accepted when the best
+distance is a confident match (<= accept_distance) and the nearest hot row of a different
+identity is at least `margin` further away; otherwise the caller falls back to a full search.
+"""
+
+import threading
+import torch
+
+from ann_index import exact_search
+
+HOT_TIER_SIZE = 256  # Gallery rows kept in the hot tier (0 disables it)
+HOT_ACCEPT_DISTANCE = 0.6  # Best hot distance at or below which a match is considered confident
+HOT_MARGIN = 0.2  # Required distance gap to the closest other identity in the hot tier
+
+
+class HotTier:
+    """Hot rows of one gallery. The searchable snapshot is replaced, never mutated."""
+
+    def __init__(
+        self, capacity=HOT_TIER_SIZE, accept_distance=HOT_ACCEPT_DISTANCE, margin=HOT_MARGIN,
+        decay_every=1000, rebuild_every=16
+    ):
+        self.capacity = capacity
+        self.accept_distance = accept_distance
+        self.margin = margin
+        self.decay_every = decay_every
+        self.rebuild_every = rebuild_every
+        self.gallery = None  # Gallery the row ids refer to, adopted on the first record()
+        self.counts = {}
+        self.updates = 0
+        self.snapshot = (None, [], [], None)  # (gallery, row ids, names, vectors)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hot_rows': len(self.snapshot[1]),
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def search(self, queries, gallery):
+        """Returns a list holding (distance, row id) for each query the hot tier can answer
+        confidently from gallery, or None where a full search is needed.
+        """
+        snapshot_gallery, ids, names, vectors = self.snapshot
+        if not ids or snapshot_gallery is not gallery:
+            self.misses += len(queries)
+            return [None] * len(queries)
+
+        dists, top = exact_search(queries, vectors, min(len(ids), 8))
+        results = []
+        for row_dists, row_top in zip(dists.tolist(), top.tolist()):
+            best_name = names[row_top[0]]
+            runner_up = next(
+                (d for d, j in zip(row_dists[1:], row_top[1:]) if names[j] != best_name), None
+            )
+            confident = row_dists[0] <= self.accept_distance and (
+                runner_up is None or runner_up - row_dists[0] >= self.margin
+            )
+            results.append((row_dists[0], ids[row_top[0]]) if confident else None)
+        hits = sum(result is not None for result in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def record(self, row_ids, gallery):
+        """Counts matched rows and periodically rebuilds the hot set from gallery."""
+        with self.lock:
+            if self.gallery is None:
+                self.gallery = gallery
+            elif gallery is not self.gallery:
+                return
+            for row in row_ids:
+                self.counts[row] = self.counts.get(row, 0.0) + 1.0
+                self.updates += 1
+                if self.updates % self.decay_every == 0:
+                    self.counts = {r: c / 2 for r, c in self.counts.items() if c >= 0.5}
+            if self.updates % self.rebuild_every < len(row_ids) or not self.snapshot[1]:
+                self._rebuild(gallery)
+
+    def _rebuild(self, gallery):
+        hot = sorted(self.counts, key=self.counts.get, reverse=True)[:self.capacity]
+        if not hot:
+            return
+        vectors = gallery.vectors(torch.tensor(hot)).float()
+        self.snapshot = (gallery, hot, [gallery.names[i] for i in hot], vectors)
+
+    def clear(self, gallery=None):
+        """Drops counts and the snapshot; later records are only accepted for gallery."""
+        with self.lock:
+            self.gallery = gallery
+            self.counts = {}
+            self.updates = 0
+            self.snapshot = (None, [], [], None)
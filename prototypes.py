@@ -0,0 +1,228 @@
+"""Per-identity prototype compression of a gallery.
+
+Each identity's enrollment embeddings are clustered into at most `max_per_identity` prototypes,
+so a query scans one small matrix of prototypes instead of every enrolled row. When the best
+and runner-up identities are within `margin` of each other, the candidates within that margin
+are re-checked against all of their full-precision rows.
+
+    python prototypes.py build gallery gallery.protos --max-per-identity 3 \\
+        --eval-images facenet_pytorch/data/test_images
+"""
+
+import math
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+
+from ann_index import exact_search, kmeans
+from gallery import Gallery
+
+PROTOTYPES_VERSION = 1
+MAX_PER_IDENTITY = 3
+RECHECK_MARGIN = 0.1  # Distance gap below which the full rows of the candidates are re-scored
+
+
+class PrototypeIndex:
+    """Prototype-level search over a gallery, returning ids of rows in that gallery.
+
+    `identity_rows[identity_offsets[i]:identity_offsets[i + 1]]` are the gallery rows of identity
+    i. Each prototype belongs to one identity and points at its closest member row, which is the
+    id reported when no re-check happens.
+    """
+
+    def __init__(
+        self, prototypes, proto_identity, proto_rows, identity_rows, identity_offsets,
+        vectors=None, margin=RECHECK_MARGIN
+    ):
+        self.prototypes = prototypes
+        self.sq_norms = prototypes.pow(2).sum(dim=1)
+        self.proto_identity = proto_identity
+        self.proto_rows = proto_rows
+        self.per_identity = int(torch.bincount(proto_identity).max()) if len(proto_identity) else 1
+        self.identity_rows = identity_rows
+        self.identity_offsets = identity_offsets
+        self.vectors = vectors
+        self.margin = margin
+        self.rechecks = 0
+
+    @property
+    def ntotal(self):
+        return len(self.identity_rows)
+
+    @property
+    def nprototypes(self):
+        return len(self.prototypes)
+
+    @classmethod
+    def build(cls, embeddings, names, max_per_identity=MAX_PER_IDENTITY, niter=10, seed=0):
+        """Clusters the rows of each identity into at most max_per_identity prototypes."""
+        embeddings = embeddings.float()
+        groups = OrderedDict()
+        for row, name in enumerate(names):
+            groups.setdefault(name, []).append(row)
+
+        generator = torch.Generator().manual_seed(seed)
+        prototypes, proto_identity, proto_rows = [], [], []
+        identity_rows, identity_offsets = [], [0]
+        for identity, rows in enumerate(groups.values()):
+            members = embeddings[rows]
+            if len(rows) <= max_per_identity:
+                centers = members
+            else:
+                centers = kmeans(F.normalize(members, dim=1), max_per_identity, niter, generator)
+                centers = centers * members.norm(dim=1).mean()
+            closest = exact_search(centers, members, 1)[1][:, 0]
+            prototypes.append(centers)
+            proto_identity.extend([identity] * len(centers))
+            proto_rows.extend(rows[i] for i in closest.tolist())
+            identity_rows.extend(rows)
+            identity_offsets.append(len(identity_rows))
+
+        return cls(
+            torch.cat(prototypes).contiguous(),
+            torch.tensor(proto_identity),
+            torch.tensor(proto_rows),
+            torch.tensor(identity_rows),
+            torch.tensor(identity_offsets),
+            embeddings,
+        )
+
+    def _recheck(self, query, identities):
+        """Returns (distance, row) of the closest full row for each identity."""
+        results = []
+        for identity in identities:
+            start, end = self.identity_offsets[identity], self.identity_offsets[identity + 1]
+            rows = self.identity_rows[start:end]
+            dists, top = exact_search(query, self.vectors[rows].float(), 1)
+            results.append((dists[0, 0].item(), rows[top[0, 0]].item()))
+        return results
+
+    def search(self, queries, k=1, nprobe=None):
+        """Returns (distances, ids) of the k closest identities per query, one row id each.
+
+        Unlike IVFIndex and exact_search, k counts identities rather than rows: the k results
+        never hold two rows of one identity. With the gallery vectors available, each distance is
+        the exact distance to the reported row, so results merge with other row searches;
+        without them it is the distance to the identity's prototype. nprobe is accepted for
+        interface compatibility with IVFIndex and ignored.
+        """
+        queries = queries.reshape(-1, self.prototypes.shape[1]).float()
+        n_candidates = min(self.nprototypes, max(k, 2) * self.per_identity * 4)
+        proto_dists, proto_ids = exact_search(queries, self.prototypes, n_candidates, self.sq_norms)
+        proto_identities = self.proto_identity[proto_ids].tolist()
+        proto_rows = self.proto_rows[proto_ids].tolist()
+
+        distances = torch.full((len(queries), k), math.inf)
+        ids = torch.full((len(queries), k), -1, dtype=torch.long)
+        for qi in range(len(queries)):
+            # Best prototype per identity, in increasing distance order
+            best = OrderedDict()
+            ranked = zip(proto_dists[qi].tolist(), proto_identities[qi], proto_rows[qi])
+            for dist, identity, row in ranked:
+                if identity not in best:
+                    best[identity] = (dist, row)
+            candidates = list(best.items())
+
+            if self.vectors is not None and len(candidates) > 1:
+                cutoff = candidates[0][1][0] + self.margin
+                close = [identity for identity, (dist, _) in candidates if dist <= cutoff]
+                if len(close) > 1:
+                    self.rechecks += 1
+                    for identity, result in zip(close, self._recheck(queries[qi], close)):
+                        best[identity] = result
+                    candidates = sorted(best.items(), key=lambda item: item[1][0])
+
+            chosen = [(dist, row) for _, (dist, row) in candidates[:k]]
+            if self.vectors is not None:
+                # Re-score against the reported rows: prototype distances are not row distances
+                rows = [row for _, row in chosen]
+                exact = (self.vectors[rows].float() - queries[qi]).norm(dim=1).tolist()
+                chosen = sorted(zip(exact, rows))
+            for j, (dist, row) in enumerate(chosen):
+                distances[qi, j] = dist
+                ids[qi, j] = row
+        return distances, ids
+
+    def save(self, path):
+        torch.save({
+            'version': PROTOTYPES_VERSION,
+            'kind': 'prototypes',
+            'prototypes': self.prototypes,
+            'proto_identity': self.proto_identity,
+            'proto_rows': self.proto_rows,
+            'identity_rows': self.identity_rows,
+            'identity_offsets': self.identity_offsets,
+            'margin': self.margin,
+        }, path)
+
+    @classmethod
+    def from_state(cls, state, vectors=None):
+        if state.get('version') != PROTOTYPES_VERSION:
+            raise ValueError(f"Unsupported prototype index version {state.get('version')}")
+        return cls(
+            state['prototypes'], state['proto_identity'], state['proto_rows'],
+            state['identity_rows'], state['identity_offsets'], vectors, state['margin'],
+        )
+
+
+def evaluate(gallery, index, image_root):
+    """Compares prototype search with exact search on an ImageFolder of test images.
+
+    Returns a dict with the number of evaluated faces, top-1 accuracy against the folder names
+    for both searches, their agreement and the share of queries that needed a re-check.
+    """
+    from torchvision import datasets
+    from face_recognition import mtcnn, resnet
+
+    dataset = datasets.ImageFolder(image_root)
+    labels, embeddings = [], []
+    with torch.inference_mode():
+        for img, label in dataset:
+            face = mtcnn(img)
+            if face is not None:
+                embeddings.append(resnet(face.unsqueeze(0)))
+                labels.append(dataset.classes[label])
+    if not embeddings:
+        return {'faces': 0}
+
+    queries = torch.cat(embeddings)
+    index.rechecks = 0
+    exact_ids = gallery.search(queries, 1)[1][:, 0].tolist()
+    proto_ids = index.search(queries, 1)[1][:, 0].tolist()
+    exact_names = [gallery.names[i] for i in exact_ids]
+    proto_names = [gallery.names[i] for i in proto_ids]
+    n = len(labels)
+    return {
+        'faces': n,
+        'exact_accuracy': sum(a == b for a, b in zip(exact_names, labels)) / n,
+        'prototype_accuracy': sum(a == b for a, b in zip(proto_names, labels)) / n,
+        'agreement': sum(a == b for a, b in zip(exact_names, proto_names)) / n,
+        'recheck_rate': index.rechecks / n,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compress a gallery into per-identity prototypes.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('gallery', help="data.pt or gallery directory")
+    build_parser.add_argument('output', help="Path of the prototype index file to write")
+    build_parser.add_argument('--max-per-identity', type=int, default=MAX_PER_IDENTITY)
+    build_parser.add_argument('--margin', type=float, default=RECHECK_MARGIN)
+    build_parser.add_argument('--eval-images', default=None,
+                              help="ImageFolder used to report the accuracy cost")
+    args = parser.parse_args()
+
+    gallery = Gallery.open(args.gallery)
+    index = PrototypeIndex.build(gallery.full, list(gallery.names), args.max_per_identity)
+    index.margin = args.margin
+    index.save(args.output)
+    print(f"[SUCCESS] {len(gallery)} rows -> {index.nprototypes} prototypes "
+          f"({index.nprototypes / max(len(gallery), 1):.1%} of rows scanned) -> {args.output}")
+
+    if args.eval_images:
+        report = evaluate(gallery, index, args.eval_images)
+        for key, value in report.items():
+            print(f"[INFO] {key}: {value:.4f}" if isinstance(value, float) else f"[INFO] {key}: {value}")
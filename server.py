@@ -1,9 +1,20 @@
 from fastapi import FastAPI, UploadFile, File
-from starlette.responses import PlainTextResponse, JSONResponse
+from starlette.responses import PlainTextResponse, JSONResponse, StreamingResponse
 import boto3
 import os
 import asyncio
-import threading
+import hashlib
+import heapq
+import json
+import math
+import re
+import socket
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import partial
 
 # ---------- Configuration ----------
 ASU_ID = "1232089042"
@@ -13,10 +24,22 @@ PORT = 8000
 server_running = True
 REQ_QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/390844739554/1232089042-req-queue'
 RESP_QUEUE_URL  = 'https://sqs.us-east-1.amazonaws.com/390844739554/1232089042-resp-queue'
-
-# Store results and waiting events
-RESULTS = {}  # Example: {"cat.jpg": "cat.jpg:dog"}
-WAIT_EVENTS = {}  # Tracks files waiting for processing
+REQUEST_TIMEOUT = 30  # Seconds a client waits for a result; workers drop requests older than this
+RECEIVE_WAIT_SECONDS = 20  # Response-queue long-poll wait
+RESULT_TTL = 60  # Seconds a result nobody is waiting for is kept for a late request
+MAX_ORPHANS = 10000  # Unclaimed results kept at most
+CACHE_TTL = 300  # Seconds a result is answered from the content-hash cache
+CACHE_SIZE = 10000  # Results kept in the cache at most
+LATENCY_BUDGET = float(os.environ.get("SERVER_LATENCY_BUDGET", REQUEST_TIMEOUT * 2 / 3))  # Expected seconds to a result above which requests are turned away
+DEPTH_POLL_INTERVAL = 2  # Seconds between request-queue depth samples
+RATE_WINDOW = 30  # Seconds of results the drain rate is measured over
+SERVICE_TIME_WEIGHT = 0.2  # Weight of the newest worker service time in its moving average
+MIN_SERVICE_TIME = 0.001  # Floor on the service time the drain rate is derived from
+MAX_RETRY_AFTER = 60  # Longest Retry-After handed to a turned-away client
+JOB_TTL = 600  # Seconds a finished job's result is kept for polling and reconnecting streams
+SSE_KEEPALIVE = 15  # Seconds between keep-alive comments on an idle event stream
+PRIVATE_RESPONSE_QUEUE = os.environ.get("SERVER_PRIVATE_RESPONSE_QUEUE", "1") == "1"  # One response queue per server process
+MAX_RESULT_RECEIVES = 10  # Receives after which an unclaimed result on the shared response queue is dropped
 
 # ========== AWS Clients ==========
 aws_session = boto3.Session(region_name="us-east-1")
@@ -24,66 +47,415 @@ s3 = aws_session.client('s3')  # For file storage
 sqs = aws_session.client('sqs')  # For task queues
 
 # ========== FastAPI App ==========
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # The dispatcher runs on the server's event loop for the lifetime of the app
+    if PRIVATE_RESPONSE_QUEUE:
+        dispatcher.queue_url = create_response_queue()
+    tasks = [asyncio.create_task(coro) for coro in (dispatcher.run(), admission.run(), jobs.run())]
+    yield
+    for task in tasks:
+        task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # ========== Helper Functions ==========
-def upload_to_s3(file_content: bytes, filename: str):
+def upload_to_s3(file_content: bytes, key: str):
     """Uploads a file to S3 bucket"""
     try:
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=filename, Body=file_content)
-        print(f"[DEBUG] Uploaded {filename} to S3 bucket {S3_BUCKET_NAME}")
+        s3.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=file_content)
+        print(f"[DEBUG] Uploaded {key} to S3 bucket {S3_BUCKET_NAME}")
     except Exception as e:
         print(f"[ERROR] Failed to upload to S3: {e}")
         return False
     return True
 
-def send_to_request_queue(filename: str):
-    """Sends a filename to the SQS request queue"""
+_slot_lock = None  # Lock file held for the process lifetime; its slot names the response queue
+
+def claim_slot():
+    """Claims the lowest free per-host slot number, freed again when this process exits"""
+    global _slot_lock
+    import fcntl
+    slot = 0
+    while True:
+        f = open(os.path.join(tempfile.gettempdir(), f"{ASU_ID}-resp-slot{slot}.lock"), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            slot += 1
+            continue
+        _slot_lock = f
+        return slot
+
+def create_response_queue():
+    """Returns the response queue of this server process, or the shared one if it can't be created
+
+    Queues are named by host and slot rather than pid, so a restarted worker reuses the queue of
+    the one it replaces instead of leaking a new one, and they are kept on shutdown for that reason.
+    """
+    global _slot_lock
+    try:
+        slot = claim_slot()
+        if slot > 0:
+            print("[WARNING] Another server process runs on this host; jobs are only visible to the process that took them")
+        name = re.sub(r'[^A-Za-z0-9_-]', '-', f"{ASU_ID}-resp-{socket.gethostname()}-{slot}")[:80]
+        url = sqs.create_queue(QueueName=name, Attributes={'MessageRetentionPeriod': '600'})['QueueUrl']
+    except Exception as e:
+        if _slot_lock is not None:
+            _slot_lock.close()
+            _slot_lock = None
+        print(f"[WARNING] Failed to create a private response queue, using the shared one: {e}")
+        return RESP_QUEUE_URL
+    print(f"[INFO] Receiving results on {url}")
+    return url
+
+def send_to_request_queue(filename: str, deadline: float, request_id: str, key: str):
+    """Sends a filename to the SQS request queue
+
+    Attributes carry the time after which nobody waits for the result, the request ID the
+    result is routed by, the queue to reply to and the S3 key of the upload.
+    """
     try:
-        sqs.send_message(QueueUrl=REQ_QUEUE_URL, MessageBody=filename)
+        sqs.send_message(
+            QueueUrl=REQ_QUEUE_URL,
+            MessageBody=filename,
+            MessageAttributes={
+                'Deadline': {'DataType': 'Number', 'StringValue': f"{deadline:.3f}"},
+                'RequestId': {'DataType': 'String', 'StringValue': request_id},
+                'ReplyTo': {'DataType': 'String', 'StringValue': dispatcher.queue_url},
+                'S3Key': {'DataType': 'String', 'StringValue': key},
+            },
+        )
         print(f"[DEBUG] Sent {filename} to request queue")
     except Exception as e:
         print(f"[ERROR] Failed to send to SQS: {e}")
         return False
     return True
 
-def fetch_results_from_queue():
-    """Continuously checks the response queue for results (runs in background)"""
-    while True:
+# ========== Result Dispatcher ==========
+class ResultDispatcher:
+    """Routes response-queue results to the requests waiting for them, on the event loop
+
+    run() long-polls the response queue in batches (the blocking SQS calls go to the default
+    executor) and resolves one future per waiting request ID, which workers echo back as the
+    RequestId attribute of the result. Requests subscribe before they are sent. On a private
+    queue, a result nobody is waiting for (a late one) is kept for RESULT_TTL seconds, and at
+    most MAX_ORPHANS of them are kept. On the shared queue such a result belongs to another
+    server process: it is left on the queue for that process, and only dropped after
+    MAX_RESULT_RECEIVES receives. Every result's gallery version is reported to the result
+    cache before the result is handed out.
+    """
+
+    def __init__(self, queue_url=RESP_QUEUE_URL):
+        self.queue_url = queue_url
+        self.waiters = {}  # request ID -> Future
+        self.orphans = OrderedDict()  # request ID -> ((result, gallery version), expiry), oldest first
+        self.stats = {
+            'received': 0, 'delivered': 0, 'orphaned': 0, 'evicted': 0, 'timeouts': 0,
+            'passed_on': 0, 'dropped': 0,
+        }
+
+    def subscribe(self, request_id: str) -> asyncio.Future:
+        """Returns a future of (result, gallery version) for request_id, already done if the
+        result arrived first
+        """
+        future = asyncio.get_running_loop().create_future()
+        orphan = self.orphans.pop(request_id, None)
+        if orphan is not None:
+            self.stats['delivered'] += 1
+            future.set_result(orphan[0])
+        else:
+            self.waiters[request_id] = future
+        return future
+
+    def unsubscribe(self, request_id: str, future: asyncio.Future):
+        if self.waiters.get(request_id) is future:
+            del self.waiters[request_id]
+
+    async def wait(self, request_id: str, timeout: float) -> tuple:
+        """Returns (result, gallery version) for request_id, or raises asyncio.TimeoutError after
+        timeout seconds
+        """
+        future = self.subscribe(request_id)
         try:
-            # Check for new messages
-            response = sqs.receive_message(
-                QueueUrl=RESP_QUEUE_URL,
-                MaxNumberOfMessages=10,
-                VisibilityTimeout=5,
-            )
-            messages = response.get('Messages', [])
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+        finally:
+            self.unsubscribe(request_id, future)
 
-            if not messages:
-                print("[DEBUG] No messages in response queue")
-                continue
+    def resolve(self, request_id: str, result: str, version=None):
+        """Hands a result to its waiter, or keeps it until a waiter arrives or it expires"""
+        self.stats['received'] += 1
+        future = self.waiters.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result((result, version))
+            self.stats['delivered'] += 1
+            return
+        self.orphans.pop(request_id, None)
+        self.orphans[request_id] = ((result, version), time.monotonic() + RESULT_TTL)
+        self.stats['orphaned'] += 1
+        while len(self.orphans) > MAX_ORPHANS:
+            self.orphans.popitem(last=False)
+            self.stats['evicted'] += 1
 
-            # Process each message
-            for msg in messages:
-                receipt_handle = msg['ReceiptHandle']
-                result = msg['Body']  # Format: "filename:classification"
+    def evict(self):
+        """Drops unclaimed results older than RESULT_TTL"""
+        now = time.monotonic()
+        while self.orphans:
+            request_id, (_, expiry) = next(iter(self.orphans.items()))
+            if expiry > now:
+                break
+            del self.orphans[request_id]
+            self.stats['evicted'] += 1
 
-                # Example: "cat.jpg:dog" → store in RESULTS
-                filename, classification = result.split(':')
-                RESULTS[filename] = f"{filename}:{classification}"
-                print(f"[DEBUG] Received result: {filename} → {classification}")
+    async def run(self):
+        """Long-polls the response queue forever"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                response = await loop.run_in_executor(None, partial(
+                    sqs.receive_message,
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=10,
+                    WaitTimeSeconds=RECEIVE_WAIT_SECONDS,
+                    VisibilityTimeout=5,
+                    MessageAttributeNames=['RequestId', 'GalleryVersion', 'ServiceTime'],
+                    AttributeNames=['ApproximateReceiveCount'],
+                ))
+                messages = response.get('Messages', [])
+                shared = self.queue_url == RESP_QUEUE_URL
+                handled = []
 
-                # Notify waiting requests
-                if filename in WAIT_EVENTS:
-                    WAIT_EVENTS[filename].set()
+                for msg in messages:
+                    result = msg['Body']  # Format: "filename:classification"
+                    filename, classification = result.rsplit(':', 1)
+                    attributes = {
+                        name: value['StringValue']
+                        for name, value in msg.get('MessageAttributes', {}).items()
+                    }
+                    request_id = attributes.get('RequestId')
+                    if request_id is None:
+                        print(f"[ERROR] Result for {filename} has no request ID; dropping it")
+                        handled.append(msg)
+                        continue
+                    if shared and request_id not in self.waiters:
+                        # Another server process's result: it is received again once visible
+                        receives = int(msg.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+                        if receives < MAX_RESULT_RECEIVES:
+                            self.stats['passed_on'] += 1
+                            continue
+                        print(f"[ERROR] Nobody claimed the result for {filename}; dropping it")
+                        self.stats['dropped'] += 1
+                        handled.append(msg)
+                        continue
+                    handled.append(msg)
+                    print(f"[DEBUG] Received result: {filename} → {classification}")
+                    version = result_cache.observe(attributes.get('GalleryVersion'))
+                    admission.completed(attributes.get('ServiceTime'))
+                    self.resolve(request_id, result, version)
 
-                # Delete processed message
-                sqs.delete_message(QueueUrl=RESP_QUEUE_URL, ReceiptHandle=receipt_handle)
+                if handled:
+                    await loop.run_in_executor(None, partial(
+                        sqs.delete_message_batch,
+                        QueueUrl=self.queue_url,
+                        Entries=[
+                            {'Id': str(i), 'ReceiptHandle': msg['ReceiptHandle']}
+                            for i, msg in enumerate(handled)
+                        ],
+                    ))
+                self.evict()
 
-        except Exception as e:
-            print(f"[ERROR] Failed to process SQS messages: {e}")
+            except Exception as e:
+                print(f"[ERROR] Failed to process SQS messages: {e}")
+                await asyncio.sleep(1)
+
+dispatcher = ResultDispatcher()
+
+# ========== Result Cache ==========
+class ResultCache:
+    """Classifications by SHA-256 of the uploaded image, plus the uploads currently in flight
+
+    Entries expire after CACHE_TTL seconds, and the least recently used are dropped beyond
+    CACHE_SIZE. Workers tag each result with the version of the gallery they searched:
+    "generation.rows.fingerprint", where the fingerprint hashes a sample of the gallery's content.
+    A version with a higher (generation, rows), or the same with a different fingerprint (a
+    regenerated gallery), clears the cache, and only results from the current version are cached.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # digest -> (classification, expiry)
+        self.in_flight = {}  # digest -> Future of the request doing the work
+        self.version = None
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'invalidations': 0}
+
+    def get(self, digest: str):
+        entry = self.entries.get(digest)
+        if entry is None or entry[1] <= time.monotonic():
+            self.entries.pop(digest, None)
+            return None
+        self.entries.move_to_end(digest)
+        self.stats['hits'] += 1
+        return entry[0]
+
+    def put(self, digest: str, classification: str, version):
+        if version is None or version != self.version or classification == 'error':
+            return
+        self.entries[digest] = (classification, time.monotonic() + CACHE_TTL)
+        self.entries.move_to_end(digest)
+        while len(self.entries) > CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    def observe(self, version: str):
+        """Records the gallery version of a result, clearing the cache when it is newer. Returns
+        the parsed version.
+        """
+        if not version:
+            return None
+        generation, rows, fingerprint = version.split('.')
+        version = ((int(generation), int(rows)), fingerprint)
+        if self.version is None or version[0] > self.version[0] or (
+            version[0] == self.version[0] and version[1] != self.version[1]
+        ):
+            if self.entries:
+                self.stats['invalidations'] += 1
+                self.entries.clear()
+            self.version = version
+        return version
+
+result_cache = ResultCache()
+
+# ========== Admission Control ==========
+class AdmissionController:
+    """Turns requests away while the expected time to their result exceeds LATENCY_BUDGET
+
+    expected wait = service time + backlog / drain rate, where
+      service time: moving average of the seconds workers hold a task, reported with each result
+      backlog: messages waiting in the request queue (sampled every DEPTH_POLL_INTERVAL seconds)
+               plus the requests this process has sent since the sample
+      drain rate: results per second received over the last RATE_WINDOW seconds, or by Little's
+               law the messages held by workers over the service time, whichever is higher
+    Until a first service time is reported nothing is known, and every request is admitted.
+    Zero service times (error replies for quarantined messages) are not samples and are skipped.
+    """
+
+    def __init__(self, budget=LATENCY_BUDGET):
+        self.budget = budget
+        self.service_time = None
+        self.queued = 0  # Visible request-queue messages at the last sample
+        self.processing = 0  # Request-queue messages held by workers at the last sample
+        self.sent = 0  # Requests admitted since the last sample
+        self.results = deque()  # Receive times of recent results
+        self.started = time.monotonic()
+        self.stats = {'admitted': 0, 'shed': 0, 'expected_wait': 0.0}
+
+    def completed(self, service_time):
+        now = time.monotonic()
+        self.results.append(now)
+        try:
+            service_time = float(service_time)
+        except (TypeError, ValueError):
+            return
+        if service_time > 0:
+            self.service_time = service_time if self.service_time is None else (
+                SERVICE_TIME_WEIGHT * service_time + (1 - SERVICE_TIME_WEIGHT) * self.service_time
+            )
+
+    def drain_rate(self) -> float:
+        now = time.monotonic()
+        while self.results and self.results[0] < now - RATE_WINDOW:
+            self.results.popleft()
+        measured = len(self.results) / max(1.0, min(RATE_WINDOW, now - self.started))
+        return max(measured, max(1, self.processing) / max(MIN_SERVICE_TIME, self.service_time))
+
+    def expected_wait(self) -> float:
+        if self.service_time is None:
+            return 0.0
+        return self.service_time + (self.queued + self.sent) / self.drain_rate()
+
+    def admit(self):
+        """Returns None if the request may be sent, or the seconds the client should retry after"""
+        wait = self.expected_wait()
+        self.stats['expected_wait'] = round(wait, 3)
+        if wait > self.budget:
+            self.stats['shed'] += 1
+            return min(MAX_RETRY_AFTER, max(1, math.ceil(wait - self.budget)))
+        self.stats['admitted'] += 1
+        self.sent += 1
+        return None
+
+    async def run(self):
+        """Samples the request-queue depth until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                response = await loop.run_in_executor(None, partial(
+                    sqs.get_queue_attributes,
+                    QueueUrl=REQ_QUEUE_URL,
+                    AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'],
+                ))
+                attributes = response['Attributes']
+                self.queued = int(attributes['ApproximateNumberOfMessages'])
+                self.processing = int(attributes['ApproximateNumberOfMessagesNotVisible'])
+                self.sent = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Failed to read request queue depth: {e}")
+            await asyncio.sleep(DEPTH_POLL_INTERVAL)
+
+admission = AdmissionController()
 
 # ========== API Endpoint ==========
+class RequestFailed(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def busy(retry_after: int):
+    """The 429 response for a request turned away by admission control"""
+    return JSONResponse(
+        status_code=429, content={"detail": "Server busy, retry later"},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+async def submit(file_content: bytes, filename: str, request_id: str) -> float:
+    """Uploads an image and sends it to the request queue. Returns the request's deadline
+
+    The request must already be subscribed to the dispatcher, so its result is recognised.
+    """
+    loop = asyncio.get_running_loop()
+    # Upload to S3 under a per-request key, so equal filenames do not collide
+    key = f"{request_id}/{filename}"
+    if not await loop.run_in_executor(None, upload_to_s3, file_content, key):
+        raise RequestFailed(500, "S3 upload failed")
+
+    # Send filename to request queue
+    deadline = time.time() + REQUEST_TIMEOUT
+    if not await loop.run_in_executor(None, send_to_request_queue, filename, deadline, request_id, key):
+        raise RequestFailed(500, "SQS send failed")
+    return deadline
+
+async def recognize(file_content: bytes, filename: str) -> tuple:
+    """Runs one upload through S3, the request queue and a worker. Returns (classification, gallery version)"""
+    request_id = uuid.uuid4().hex
+    future = dispatcher.subscribe(request_id)
+    try:
+        deadline = await submit(file_content, filename, request_id)
+
+        # Wait for result (max REQUEST_TIMEOUT seconds)
+        result, version = await asyncio.wait_for(future, max(0, deadline - time.time()))
+    except asyncio.TimeoutError:
+        dispatcher.stats['timeouts'] += 1
+        print(f"[ERROR] Timed out waiting for {filename}")
+        raise RequestFailed(504, "Timed out waiting for result")
+    finally:
+        dispatcher.unsubscribe(request_id, future)
+    return result.rsplit(':', 1)[1], version
+
 @app.post("/", response_class=PlainTextResponse)
 async def predict_image(inputFile: UploadFile = File(...)):
     """
@@ -96,37 +468,292 @@ async def predict_image(inputFile: UploadFile = File(...)):
         filename = inputFile.filename
         print(f"[DEBUG] Received file: {filename}")
 
-        # 2. Upload to S3
-        if not upload_to_s3(file_content, filename):
-            return JSONResponse(status_code=500, content={"detail": "S3 upload failed"})
+        # 2. Answer from the cache, or join an identical upload that is already being processed
+        digest = hashlib.sha256(file_content).hexdigest()
+        classification = result_cache.get(digest)
+        if classification is not None:
+            return f"{filename}:{classification}"
+        leader = result_cache.in_flight.get(digest)
+        if leader is not None:
+            result_cache.stats['coalesced'] += 1
+            classification = await asyncio.shield(leader)
+            return f"{filename}:{classification}"
 
-        # 3. Send filename to request queue
-        if not send_to_request_queue(filename):
-            return JSONResponse(status_code=500, content={"detail": "SQS send failed"})
+        # 3. Turn the request away if its result would not arrive within the latency budget
+        retry_after = admission.admit()
+        if retry_after is not None:
+            print(f"[WARNING] Shedding {filename}: expected wait {admission.stats['expected_wait']}s")
+            return busy(retry_after)
 
-        # 4. Wait for result (max 30 seconds)
-        wait_event = asyncio.Event()
-        WAIT_EVENTS[filename] = wait_event
+        # 4. Process it ourselves
+        result_cache.stats['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        result_cache.in_flight[digest] = future
+        try:
+            classification, version = await recognize(file_content, filename)
+            result_cache.put(digest, classification, version)
+            future.set_result(classification)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del result_cache.in_flight[digest]
+            if not future.done():  # The client went away; uploads that joined this one fail too
+                future.set_exception(RequestFailed(500, "Request cancelled"))
+            future.exception()  # Marks a failure retrieved, so one nobody joined is not logged again
+        return f"{filename}:{classification}"
 
-    
-        await wait_event.wait()
-        result = RESULTS.pop(filename)
-        file_name, prediction = result.split(':')
-        return f"{file_name}:{prediction}"
-    
+    except RequestFailed as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
 
     except Exception as e:
         print(f"[ERROR] Prediction failed: {e}")
         return JSONResponse(status_code=500, content={"detail": "Internal server error"})
 
-    finally:
-        # Cleanup
-        WAIT_EVENTS.pop(filename, None)
-        RESULTS.pop(filename, None)
+# ========== Jobs ==========
+class Job:
+    __slots__ = ('id', 'filename', 'status', 'classification', 'error', 'expires', 'listeners', 'cancel')
+
+    def __init__(self, filename: str):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = 'queued'  # queued, done or failed
+        self.classification = None
+        self.error = None
+        self.expires = None  # When a finished job is dropped
+        self.listeners = []  # Event-stream queues waiting for this job
+        self.cancel = None  # Stops waiting for the worker's result when the job times out
+
+    def to_dict(self):
+        job = {'id': self.id, 'filename': self.filename, 'status': self.status}
+        if self.status == 'done':
+            job['result'] = f"{self.filename}:{self.classification}"
+        elif self.status == 'failed':
+            job['error'] = self.error
+        return job
+
+class JobStore:
+    """Jobs submitted through the job API, finished by callbacks rather than waiting coroutines
+
+    A queued job costs a Job and a dispatcher future, so tens of thousands can be outstanding.
+    One heap of (time, job ID) drives both timeouts, when a queued job reaches its deadline,
+    and eviction, JOB_TTL seconds after a job finished.
+
+    Jobs live in this process's memory, so the job API needs the server run as one process
+    (python server.py); behind several uvicorn workers a job is only found on the one that took it.
+    """
+
+    def __init__(self):
+        self.jobs = {}  # job ID -> Job
+        self.timers = []  # heap of (time, job ID)
+        self.stats = {'submitted': 0, 'done': 0, 'failed': 0, 'expired': 0}
+
+    def create(self, filename: str) -> Job:
+        job = Job(filename)
+        self.jobs[job.id] = job
+        self.stats['submitted'] += 1
+        return job
+
+    def finish(self, job: Job, classification=None, error=None):
+        if job.status != 'queued':
+            return
+        if error is None and classification == 'error':
+            error = "Recognition failed"
+        if error is None:
+            job.status, job.classification = 'done', classification
+        else:
+            job.status, job.error = 'failed', error
+        self.stats[job.status] += 1
+        job.expires = time.time() + JOB_TTL
+        heapq.heappush(self.timers, (job.expires, job.id))
+        for listener in job.listeners:
+            listener.put_nowait(job)
+        job.listeners, job.cancel = [], None
+
+    def follow(self, job: Job, leader: asyncio.Future):
+        """Finishes job with the outcome of an identical upload already in flight"""
+        def done(future):
+            if future.exception() is not None:
+                self.finish(job, error=getattr(future.exception(), 'detail', "Internal server error"))
+            else:
+                self.finish(job, future.result())
+        leader.add_done_callback(done)
+
+    def track(self, job: Job, request_id: str, waiter: asyncio.Future, deadline: float, digest: str,
+              leader: asyncio.Future):
+        """Finishes job, and the in-flight entry it leads, when waiter (the dispatcher's future
+        for request_id) resolves
+        """
+        def settle(classification=None, error=None):
+            if result_cache.in_flight.get(digest) is leader:
+                del result_cache.in_flight[digest]
+            if error is None:
+                leader.set_result(classification)
+            else:
+                leader.set_exception(error)
+                leader.exception()  # Marks it retrieved, so a failure nobody joined is not logged again
+
+        def resolved(future):
+            if future.cancelled():
+                return
+            result, version = future.result()
+            classification = result.rsplit(':', 1)[1]
+            result_cache.put(digest, classification, version)
+            settle(classification)
+            self.finish(job, classification)
+
+        def cancel():
+            dispatcher.unsubscribe(request_id, waiter)
+            waiter.cancel()
+            dispatcher.stats['timeouts'] += 1
+            settle(error=RequestFailed(504, "Timed out waiting for result"))
+
+        job.cancel = cancel
+        waiter.add_done_callback(resolved)
+        heapq.heappush(self.timers, (deadline, job.id))
+
+    def expire(self):
+        """Times out queued jobs past their deadline and drops finished jobs past JOB_TTL"""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, job_id = heapq.heappop(self.timers)
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if job.status == 'queued':
+                print(f"[ERROR] Timed out waiting for job {job_id} ({job.filename})")
+                if job.cancel is not None:
+                    job.cancel()
+                self.finish(job, error="Timed out waiting for result")
+            elif job.expires <= now:  # Otherwise a deadline of a job that finished in time
+                del self.jobs[job_id]
+                self.stats['expired'] += 1
+
+    async def run(self):
+        """Expires jobs every second until cancelled"""
+        while True:
+            self.expire()
+            await asyncio.sleep(1)
+
+jobs = JobStore()
+
+@app.post("/jobs", status_code=202)
+async def submit_job(inputFile: UploadFile = File(...)):
+    """
+    Uploads an image for processing and returns its job without waiting for the result.
+    Poll GET /jobs/{id} or stream GET /jobs/events?ids=... for the outcome.
+    """
+    try:
+        file_content = await inputFile.read()
+        filename = inputFile.filename
+        print(f"[DEBUG] Received job file: {filename}")
+
+        # Answer from the cache, or follow an identical upload that is already being processed
+        digest = hashlib.sha256(file_content).hexdigest()
+        classification = result_cache.get(digest)
+        if classification is not None:
+            job = jobs.create(filename)
+            jobs.finish(job, classification)
+            return job.to_dict()
+        leader = result_cache.in_flight.get(digest)
+        if leader is not None:
+            result_cache.stats['coalesced'] += 1
+            job = jobs.create(filename)
+            jobs.follow(job, leader)
+            return job.to_dict()
+
+        retry_after = admission.admit()
+        if retry_after is not None:
+            print(f"[WARNING] Shedding job {filename}: expected wait {admission.stats['expected_wait']}s")
+            return busy(retry_after)
+
+        result_cache.stats['misses'] += 1
+        leader = asyncio.get_running_loop().create_future()
+        result_cache.in_flight[digest] = leader
+        request_id = uuid.uuid4().hex
+        waiter = dispatcher.subscribe(request_id)
+        try:
+            deadline = await submit(file_content, filename, request_id)
+        except BaseException as e:  # Including cancellation, or identical uploads would wait forever
+            dispatcher.unsubscribe(request_id, waiter)
+            del result_cache.in_flight[digest]
+            leader.set_exception(e if isinstance(e, Exception) else RequestFailed(500, "Request cancelled"))
+            leader.exception()
+            raise
+        job = jobs.create(filename)
+        jobs.track(job, request_id, waiter, deadline, digest, leader)
+        return job.to_dict()
+
+    except RequestFailed as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+
+    except Exception as e:
+        print(f"[ERROR] Job submission failed: {e}")
+        return JSONResponse(status_code=500, content={"detail": "Internal server error"})
+
+@app.get("/jobs/events")
+async def job_events(ids: str):
+    """
+    Server-sent events for a comma-separated list of job IDs: one "job" event per job as it
+    finishes (at once for jobs already finished, so a client can reconnect with the same IDs),
+    "missing" for unknown or expired IDs, and "end" once every job has been reported.
+    """
+    stream = asyncio.Queue()
+    pending = []
+    for job_id in dict.fromkeys(job_id for job_id in ids.split(',') if job_id):
+        job = jobs.jobs.get(job_id)
+        if job is None:
+            stream.put_nowait(job_id)
+        elif job.status == 'queued':
+            job.listeners.append(stream)
+            pending.append(job)
+        else:
+            stream.put_nowait(job)
+    remaining = stream.qsize() + len(pending)
+
+    async def events():
+        nonlocal remaining
+        try:
+            while remaining:
+                try:
+                    job = await asyncio.wait_for(stream.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                remaining -= 1
+                if isinstance(job, str):
+                    yield f"event: missing\ndata: {json.dumps({'id': job})}\n\n"
+                else:
+                    yield f"id: {job.id}\nevent: job\ndata: {json.dumps(job.to_dict())}\n\n"
+            yield "event: end\ndata: {}\n\n"
+        finally:
+            for job in pending:
+                if stream in job.listeners:
+                    job.listeners.remove(stream)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a job, with its "filename:classification" result once done"""
+    job = jobs.jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"detail": "Unknown or expired job"})
+    return job.to_dict()
 
-# ========== Start Background Thread ==========
-# Runs fetch_results_from_queue() in the background
-threading.Thread(target=fetch_results_from_queue, daemon=True).start()
+@app.get("/metrics")
+async def metrics():
+    """Dispatcher, result-cache, admission and job counters"""
+    return {
+        'admission': dict(
+            admission.stats, service_time=admission.service_time, queued=admission.queued,
+            processing=admission.processing, sent=admission.sent,
+            drain_rate=admission.drain_rate() if admission.service_time else None,
+        ),
+        'dispatcher': dict(dispatcher.stats, waiting=len(dispatcher.waiters), orphans=len(dispatcher.orphans)),
+        'cache': dict(result_cache.stats, entries=len(result_cache.entries), in_flight=len(result_cache.in_flight)),
+        'jobs': dict(jobs.stats, retained=len(jobs.jobs), timers=len(jobs.timers)),
+    }
 
 # ========== Start Server ==========
 if __name__ == "__main__":
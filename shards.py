@@ -0,0 +1,216 @@
+"""Sharded gallery: one server process per shard, searched by scatter-gather.
+
+A gallery directory is split into N shard galleries (same on-disk format) described by a
+manifest. Each shard is served by its own process over multiprocessing.connection, on a Unix
+socket by default or on "host:port" for shards living on another machine. ShardedGallery sends
+every query batch to all shards at once and merges their top-k results.
+
+    python shards.py split gallery 4              # writes gallery.shard0..3 and gallery.shards.json
+    python shards.py serve gallery.shards.json    # one server process per shard
+"""
+
+import json
+import multiprocessing
+import os
+import secrets
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+import torch
+
+from ann_index import merge_results
+from gallery import Gallery, write_gallery
+
+MANIFEST_SUFFIX = '.shards.json'
+CONNECT_TIMEOUT = 30.0  # Seconds to wait for shard servers to come up
+
+
+def _address(address):
+    """'host:port' is a TCP address, anything else is a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and os.sep not in address:
+        return host, int(port)
+    return address
+
+
+def split(path, n_shards, socket_dir=None):
+    """Splits a gallery into n_shards contiguous shard galleries. Returns the manifest path."""
+    gallery = Gallery.open(path)
+    path = path.rstrip(os.sep)
+    socket_dir = socket_dir or tempfile.gettempdir()
+    bounds = [len(gallery) * i // n_shards for i in range(n_shards + 1)]
+
+    shards = []
+    for i in range(n_shards):
+        start, end = bounds[i], bounds[i + 1]
+        shard_path = f'{path}.shard{i}'
+        write_gallery(
+            shard_path, gallery.full[start:end], [gallery.names[j] for j in range(start, end)],
+            gallery.dtype,
+        )
+        shards.append({
+            'path': os.path.abspath(shard_path),
+            'offset': start,
+            'address': os.path.join(socket_dir, f'{os.path.basename(path)}.shard{i}.sock'),
+        })
+
+    manifest_path = path + MANIFEST_SUFFIX
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'count': len(gallery),
+            'dim': gallery.dim,
+            'authkey': secrets.token_hex(16),
+            'shards': shards,
+        }, f, indent=2)
+    return manifest_path
+
+
+def _handle(gallery, conn):
+    with conn:
+        while True:
+            try:
+                op, payload = conn.recv()
+            except EOFError:
+                return
+            if op == 'search':
+                queries, k = payload
+                with torch.inference_mode():
+                    dists, ids = gallery.search(torch.from_numpy(queries), k)
+                conn.send((dists.numpy(), ids.numpy()))
+            elif op == 'names':
+                conn.send(list(gallery.names))
+            elif op == 'vectors':
+                conn.send(gallery.vectors(torch.from_numpy(payload)).float().numpy())
+            else:
+                conn.send(ValueError(f"Unknown operation {op!r}"))
+
+
+def serve_shard(shard_path, address, authkey):
+    """Serves one shard gallery until killed; each client connection gets its own thread."""
+    gallery = Gallery.open(shard_path)
+    address = _address(address)
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+    with Listener(address, authkey=authkey.encode()) as listener:
+        print(f"[INFO] Serving {shard_path} ({len(gallery)} rows) on {address}")
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_handle, args=(gallery, conn), daemon=True).start()
+
+
+def start_servers(manifest_path):
+    """Starts one process per shard in the manifest and returns the processes."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    processes = []
+    for shard in manifest['shards']:
+        process = multiprocessing.Process(
+            target=serve_shard, args=(shard['path'], shard['address'], manifest['authkey']),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def _connect(address, authkey, timeout=CONNECT_TIMEOUT):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(_address(address), authkey=authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class ShardedGallery:
+    """Client side of a sharded gallery, searched like a Gallery.
+
+    Names are fetched once at connect time; a search scatters the queries to every shard,
+    gathers their top-k and merges them. Searches are serialised per client, so use one
+    ShardedGallery per thread that needs concurrent searches, and call reopen() in a forked
+    child before searching: connections inherited from the parent are shared with it.
+    """
+
+    def __init__(self, manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.path = manifest_path
+        self.dim = manifest['dim']
+        self.offsets = [shard['offset'] for shard in manifest['shards']]
+        self.addresses = [shard['address'] for shard in manifest['shards']]
+        self.authkey = manifest['authkey'].encode()
+        self.connections = [_connect(address, self.authkey) for address in self.addresses]
+        self.lock = threading.Lock()
+
+        names = []
+        for conn in self.connections:
+            conn.send(('names', None))
+            names.extend(conn.recv())
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, queries, k=1, index=None, nprobe=None):
+        """Returns (distances, ids) of the k closest rows across all shards."""
+        payload = queries.detach().reshape(-1, self.dim).float().cpu().numpy()
+        results = []
+        with self.lock:
+            for conn in self.connections:
+                conn.send(('search', (payload, k)))
+            for conn, offset in zip(self.connections, self.offsets):
+                dists, ids = conn.recv()
+                results.append((torch.from_numpy(dists), torch.from_numpy(ids) + offset))
+        return merge_results(results, k)
+
+    def vectors(self, ids):
+        """Returns the full-precision rows for the given global ids."""
+        ids = ids.tolist()
+        rows = [None] * len(ids)
+        with self.lock:
+            for shard, (conn, offset) in enumerate(zip(self.connections, self.offsets)):
+                end = self.offsets[shard + 1] if shard + 1 < len(self.offsets) else len(self)
+                local = [(j, i - offset) for j, i in enumerate(ids) if offset <= i < end]
+                if not local:
+                    continue
+                conn.send(('vectors', torch.tensor([i for _, i in local]).numpy()))
+                for (j, _), row in zip(local, conn.recv()):
+                    rows[j] = torch.from_numpy(row)
+        return torch.stack(rows)
+
+    def refresh(self):
+        return self
+
+    def reopen(self):
+        """Replaces the connections with new ones of this process's own."""
+        self.close()
+        self.connections = [_connect(address, self.authkey) for address in self.addresses]
+        self.lock = threading.Lock()
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split and serve a sharded face gallery.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    split_parser = subparsers.add_parser('split', help="Split a gallery into shard galleries")
+    split_parser.add_argument('gallery')
+    split_parser.add_argument('shards', type=int)
+    split_parser.add_argument('--socket-dir', default=None)
+    serve_parser = subparsers.add_parser('serve', help="Serve every shard of a manifest")
+    serve_parser.add_argument('manifest')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        manifest_path = split(args.gallery, args.shards, args.socket_dir)
+        print(f"[SUCCESS] Split {args.gallery} into {args.shards} shards -> {manifest_path}")
+    else:
+        for process in start_servers(args.manifest):
+            process.join()